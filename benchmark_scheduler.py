@@ -0,0 +1,72 @@
+"""Бенчмарк планувальників повторення на синтетичних картках
+
+    python benchmark_scheduler.py [кількість карток]
+"""
+import random
+import sys
+import time
+
+import numpy as np
+
+from bot import AGAIN, DAY, EASY, GOOD, HARD, SCHEDULERS, Card, recompute_next_reviews, review_card
+
+def synthetic_cards(count, now):
+    """Картки з випадковою історією від 1 до 8 повторень"""
+    rng = random.Random(42)
+    scheduler = SCHEDULERS['sm2']
+    cards = []
+    for i in range(count):
+        card = Card(f"слово{i}", f"word{i}", id=i)
+        reviewed_at = now - rng.randint(30, 365) * DAY
+        for _ in range(rng.randint(1, 8)):
+            review_card(card, rng.choice((AGAIN, HARD, GOOD, GOOD, GOOD, EASY)), scheduler, reviewed_at)
+            reviewed_at = min(card.next_review, now)
+        cards.append(card)
+    return cards
+
+def timed(func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    now = int(time.time())
+
+    started = time.perf_counter()
+    cards = synthetic_cards(count, now)
+    print(f"Generated {count} cards in {time.perf_counter() - started:.2f}s")
+
+    # Одна відповідь - обидва алгоритми оновлюють стан картки
+    grades = [random.choice((AGAIN, HARD, GOOD, EASY)) for _ in cards]
+    for name, scheduler in SCHEDULERS.items():
+        copies = [Card(c.ukrainian, c.english, c.added_at, c.next_review, c.interval, c.id, c.ease, c.reps,
+                       c.lapses, c.stability, c.difficulty, c.last_review) for c in cards]
+        started = time.perf_counter()
+        for card, grade in zip(copies, grades):
+            review_card(card, grade, scheduler, now)
+        elapsed = time.perf_counter() - started
+        print(f"{name}: review_card {elapsed / count * 1e6:.2f} us/answer")
+
+    last_review = np.array([c.last_review for c in cards], dtype=float)
+    interval = np.array([c.interval for c in cards], dtype=float)
+    stability = np.array([c.stability for c in cards], dtype=float)
+    next_review = np.array([c.next_review for c in cards], dtype=float)
+
+    # Перерахунок розкладу всіх карток (наприклад, після зміни алгоритму чи цільової ймовірності)
+    for name, scheduler in SCHEDULERS.items():
+        elapsed, result = timed(lambda: recompute_next_reviews(scheduler, last_review, interval, stability, next_review))
+        due = int((result <= now).sum())
+        print(f"{name}: recompute {count} cards in {elapsed * 1000:.2f} ms (numpy), {due} due now")
+
+    fsrs = SCHEDULERS['fsrs']
+    elapsed, _ = timed(lambda: [
+        c.last_review + min(max(round(c.stability * fsrs.k), 1), 36500) * DAY for c in cards
+    ], repeat=3)
+    print(f"fsrs: recompute {count} cards in {elapsed * 1000:.2f} ms (pure Python loop, for comparison)")
+
+if __name__ == '__main__':
+    main()
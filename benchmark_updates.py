@@ -0,0 +1,71 @@
+"""Стрес-тест обробки апдейтів: пропускна здатність і порядок у межах користувача
+
+    python benchmark_updates.py [користувачів] [апдейтів на користувача]
+
+Обробник імітує читання-зміну-запис документа користувача з мережевими затримками.
+Для кожного процесора перевіряється, що жодне оновлення не загубилось і апдейти
+кожного користувача застосовано в порядку надходження.
+"""
+import asyncio
+import random
+import sys
+import time
+from datetime import datetime, timezone
+
+from telegram import Chat, Message, Update, User
+from telegram.ext import SimpleUpdateProcessor
+
+from bot import PerUserUpdateProcessor
+
+def make_update(update_id, user_id):
+    user = User(user_id, f"user{user_id}", False)
+    message = Message(update_id, datetime.now(timezone.utc), Chat(user_id, Chat.PRIVATE), from_user=user, text=str(update_id))
+    return Update(update_id, message=message)
+
+async def handle(update, documents, rng):
+    user_id = update.effective_user.id
+    # Читання документа, обробка (переклад, БД), запис
+    await asyncio.sleep(rng.uniform(0.001, 0.003))
+    doc = dict(documents.get(user_id, {'count': 0, 'seen': ()}))
+    await asyncio.sleep(rng.uniform(0.002, 0.008))
+    doc['count'] += 1
+    doc['seen'] += (update.update_id,)
+    await asyncio.sleep(rng.uniform(0.001, 0.003))
+    documents[user_id] = doc
+
+async def run(processor, users, per_user):
+    rng = random.Random(7)
+    documents = {}
+    # Апдейти користувачів перемішані: повідомлення одного користувача нерідко йдуть майже поспіль
+    senders = [1000 + user for user in range(users) for _ in range(per_user)]
+    rng.shuffle(senders)
+    updates = [make_update(i, user_id) for i, user_id in enumerate(senders)]
+    await processor.initialize()
+    started = time.perf_counter()
+    # Як Application: задача на кожен апдейт, створені в порядку надходження
+    tasks = [asyncio.create_task(processor.process_update(u, handle(u, documents, rng))) for u in updates]
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    await processor.shutdown()
+
+    lost = sum(per_user - doc['count'] for doc in documents.values()) + (users - len(documents)) * per_user
+    out_of_order = sum(1 for doc in documents.values() if list(doc['seen']) != sorted(doc['seen']))
+    return elapsed, lost, out_of_order
+
+async def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    total = users * per_user
+    print(f"{users} users x {per_user} updates = {total} updates")
+
+    processors = [
+        ("sequential (default)", SimpleUpdateProcessor(1)),
+        ("concurrent, no per-user lock", SimpleUpdateProcessor(32)),
+    ] + [(f"per-user, concurrency {n}", PerUserUpdateProcessor(n, 1024)) for n in (1, 8, 32, 128)]
+
+    for name, processor in processors:
+        elapsed, lost, out_of_order = await run(processor, users, per_user)
+        print(f"{name:32} {total / elapsed:8.0f} updates/s  lost updates: {lost:5}  users out of order: {out_of_order}")
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,108 +1,1295 @@
 import logging
+import copy
 import json
 import os
 import random
 import asyncio
+import threading
+import time
+import httpx
+import math
+import numpy as np
 import psycopg2
-from psycopg2.extras import Json, RealDictCursor
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
+from psycopg2.extras import Json, RealDictCursor, execute_values
+from psycopg2.pool import PoolError
 from datetime import datetime, timedelta
 from deep_translator import GoogleTranslator
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, TypeHandler, filters
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Налаштування пулу з'єднань
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_HEALTHCHECK_INTERVAL = float(os.getenv("DB_HEALTHCHECK_INTERVAL", "30"))
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+
+# Пул з'єднань з PostgreSQL
+class DatabasePool:
+    """Обмежений пул з'єднань з перевіркою стану і перепідключенням"""
+
+    def __init__(self, dsn, min_size, max_size, timeout, healthcheck_interval):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = deque()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        return psycopg2.connect(self.dsn, connect_timeout=DB_CONNECT_TIMEOUT)
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, last_used):
+        """Перевіряє що з'єднання живе перед видачею"""
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def warm_up(self):
+        """Відкриває мінімальну кількість з'єднань заздалегідь"""
+        with self._lock:
+            missing = self.min_size - len(self._idle)
+        for _ in range(max(missing, 0)):
+            conn = self._connect()
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolError(f"No free database connection after {self.timeout}s")
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn, last_used = self._idle.pop()
+                if self._is_healthy(conn, last_used):
+                    return conn
+                logger.warning("Dropping broken database connection")
+                self._close_quietly(conn)
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard=False):
+        try:
+            if discard or conn.closed:
+                self._close_quietly(conn)
+                return
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Закриває всі вільні з'єднання"""
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+db_pool = DatabasePool(DATABASE_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_HEALTHCHECK_INTERVAL)
+
+# Курсор з пулу: коміт при успіху, відкат при помилці
+@contextmanager
+def db_cursor(cursor_factory=None):
+    conn = db_pool.acquire()
+    discard = False
+    try:
+        with conn.cursor(cursor_factory=cursor_factory) as cur:
+            yield cur
+        conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        # З'єднання зламане - не повертаємо його в пул
+        discard = True
+        raise
+    except Exception:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            discard = True
+        raise
+    finally:
+        db_pool.release(conn, discard=discard)
+
 # Ініціалізація БД
 def init_database():
-    """Створює таблицю users якщо не існує"""
+    """Створює таблиці users, cards, translations і examples якщо не існують"""
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id TEXT PRIMARY KEY,
-                data JSONB NOT NULL,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+        with db_cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id TEXT PRIMARY KEY,
+                    data JSONB NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            # Версія документа для оптимістичних блокувань: кожен запис її збільшує
+            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0")
+            
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS cards (
+                    id BIGSERIAL PRIMARY KEY,
+                    user_id TEXT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+                    ukrainian TEXT NOT NULL,
+                    english TEXT NOT NULL,
+                    added_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    next_review TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    interval INTEGER NOT NULL DEFAULT 1
+                )
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS cards_user_next_review_idx ON cards (user_id, next_review)")
+            # Стан інтервального повторення: SM-2 (ease, reps, interval) і FSRS (stability, difficulty)
+            cur.execute("""
+                ALTER TABLE cards
+                    ADD COLUMN IF NOT EXISTS ease REAL NOT NULL DEFAULT 2.5,
+                    ADD COLUMN IF NOT EXISTS reps INTEGER NOT NULL DEFAULT 0,
+                    ADD COLUMN IF NOT EXISTS lapses INTEGER NOT NULL DEFAULT 0,
+                    ADD COLUMN IF NOT EXISTS stability REAL,
+                    ADD COLUMN IF NOT EXISTS difficulty REAL,
+                    ADD COLUMN IF NOT EXISTS last_review TIMESTAMP
+            """)
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS cards_user_english_idx ON cards (user_id, lower(english))")
+            
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS translations (
+                    source_text TEXT NOT NULL,
+                    source_lang TEXT NOT NULL,
+                    target_lang TEXT NOT NULL,
+                    translation TEXT NOT NULL,
+                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (source_lang, target_lang, source_text)
+                )
+            """)
+            
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS examples (
+                    word TEXT NOT NULL,
+                    source_lang TEXT NOT NULL,
+                    target_lang TEXT NOT NULL,
+                    examples JSONB NOT NULL,
+                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (source_lang, target_lang, word)
+                )
+            """)
+            
+            # Базові приклади - початкове наповнення кешу
+            execute_values(cur, """
+                INSERT INTO examples (word, source_lang, target_lang, examples)
+                VALUES %s
+                ON CONFLICT DO NOTHING
+            """, [(word, 'en', 'uk', Json(examples)) for word, examples in BASIC_EXAMPLES.items()])
+            
+            # Увімкнені нагадування з часом наступного спрацювання
+            cur.execute("SELECT to_regclass('reminders') IS NULL")
+            reminders_created = cur.fetchone()[0]
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS reminders (
+                    user_id TEXT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+                    remind_time TIME NOT NULL,
+                    next_fire_at TIMESTAMP NOT NULL,
+                    last_sent_at TIMESTAMP
+                )
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS reminders_next_fire_idx ON reminders (next_fire_at)")
         
-        conn.commit()
-        cur.close()
-        conn.close()
+        if reminders_created:
+            migrate_reminders_from_jsonb()
+        migrate_cards_from_jsonb()
+        db_pool.warm_up()
         logger.info("Database initialized successfully")
     except Exception as e:
         logger.error(f"Database init error: {e}")
 
+# Перенесення карток з users.data['cards'] у таблицю cards
+def migrate_cards_from_jsonb():
+    """Переносить картки зі старого JSONB у таблицю cards (по одному користувачу за транзакцію)"""
+    with db_cursor() as cur:
+        cur.execute("SELECT user_id FROM users WHERE data ? 'cards'")
+        user_ids = [row[0] for row in cur.fetchall()]
+    
+    for user_id in user_ids:
+        with db_cursor() as cur:
+            cur.execute("SELECT data->'cards' FROM users WHERE user_id = %s FOR UPDATE", (user_id,))
+            row = cur.fetchone()
+            if row is None:
+                continue
+            
+            rows = [card_values(user_id, Card.from_legacy(card)) for card in (row[0] or [])]
+            
+            if rows:
+                execute_values(cur, """
+                    INSERT INTO cards (user_id, ukrainian, english, added_date, next_review, interval)
+                    VALUES %s
+                    ON CONFLICT (user_id, (lower(english))) DO NOTHING
+                """, rows)
+            
+            cur.execute("UPDATE users SET data = data - 'cards' WHERE user_id = %s", (user_id,))
+    
+    if user_ids:
+        logger.info(f"Migrated cards of {len(user_ids)} users to the cards table")
+
+# Перенесення налаштувань нагадувань з users.data у таблицю reminders
+def migrate_reminders_from_jsonb():
+    now = datetime.now()
+    with db_cursor() as cur:
+        cur.execute("""
+            SELECT user_id, data->'reminders'->>'time' FROM users
+            WHERE data->'reminders'->>'enabled' = 'true'
+        """)
+        rows = [(user_id, remind_time, next_fire_time(remind_time, now)) for user_id, remind_time in cur.fetchall()]
+        
+        if rows:
+            execute_values(cur, """
+                INSERT INTO reminders (user_id, remind_time, next_fire_at)
+                VALUES %s
+                ON CONFLICT (user_id) DO NOTHING
+            """, rows)
+    
+    if rows:
+        logger.info(f"Migrated reminders of {len(rows)} users to the reminders table")
+
 # Завантаження даних користувача
 def load_user_data(user_id):
-    """Завантажує дані користувача з БД"""
+    """Завантажує дані користувача з БД. Повертає (data, version)"""
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute("SELECT data FROM users WHERE user_id = %s", (str(user_id),))
-        result = cur.fetchone()
-        
-        cur.close()
-        conn.close()
+        with db_cursor(RealDictCursor) as cur:
+            cur.execute("SELECT data, version FROM users WHERE user_id = %s", (str(user_id),))
+            result = cur.fetchone()
         
         if result:
-            return result['data']
-        return None
+            return result['data'], result['version']
+        return None, None
     except Exception as e:
         logger.error(f"Error loading user data: {e}")
-        return None
+        return None, None
 
 # Збереження даних користувача
 def save_user_data(user_id, data):
-    """Зберігає дані користувача в БД"""
+    """Створює документ нового користувача; наявний не перезаписується (зміни - через update_user_fields)
+
+    Повертає версію створеного документа або None, якщо його вже створив хтось інший.
+    """
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        
-        cur.execute("""
-            INSERT INTO users (user_id, data, updated_at)
-            VALUES (%s, %s, CURRENT_TIMESTAMP)
-            ON CONFLICT (user_id)
-            DO UPDATE SET data = %s, updated_at = CURRENT_TIMESTAMP
-        """, (str(user_id), Json(data), Json(data)))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db_cursor() as cur:
+            cur.execute("""
+                INSERT INTO users (user_id, data, updated_at)
+                VALUES (%s, %s, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id) DO NOTHING
+                RETURNING version
+            """, (str(user_id), Json(data)))
+            row = cur.fetchone()
+        return row[0] if row else None
     except Exception as e:
         logger.error(f"Error saving user data: {e}")
+        return None
 
-# Отримання всіх користувачів
-def get_all_users():
-    """Повертає всіх користувачів з БД"""
+# Часткове оновлення документа користувача
+def update_user_fields(user_id, fields=None, increments=None, expected_version=None, base=None):
+    """Оновлює лише вказані ключі JSONB через jsonb_set замість перезапису всього документа
+    
+    fields - {('reminders', 'time'): '20:00'}, increments - {('stats', 'correct'): 1}
+    expected_version - версія, з якої читались дані для змін; base - значення полів на той момент
+    Повертає True після запису, None якщо користувача немає в БД, False при помилці
+    """
+    if not fields and not increments:
+        return True
+    
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute("SELECT user_id, data FROM users")
-        results = cur.fetchall()
-        
-        cur.close()
-        conn.close()
-        
-        return {row['user_id']: row['data'] for row in results}
+        with db_cursor() as cur:
+            if execute_user_fields_update(cur, user_id, fields, increments, expected_version) is not None:
+                return True
+            if expected_version is None:
+                # Документа немає
+                return None
+            
+            # Конфлікт: документ змінився після читання. Перечитуємо під блокуванням рядка,
+            # зливаємо зміни і записуємо вже без шансу на новий конфлікт
+            cur.execute("SELECT data, version FROM users WHERE user_id = %s FOR UPDATE", (str(user_id),))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            current, version = row
+            logger.info(f"Write conflict for user {user_id}: read version {expected_version}, current {version}, merging")
+            fields = merge_user_fields(current, fields, base)
+            return execute_user_fields_update(cur, user_id, fields, increments, version) is not None
+    except Exception as e:
+        logger.error(f"Error updating user fields: {e}")
+        return False
+
+def merge_user_fields(current, fields, base=None):
+    """Зливає наші зміни полів з документом, який тим часом змінив інший запис
+
+    - лічильники (increments) - це дельти, вони додаються атомарно в SQL і не конфліктують;
+    - поле, яке змінили лише ми, записується як є;
+    - поле, значення якого ми не змінювали (дорівнює base), не перетирає чужу зміну;
+    - поле, яке змінили обидва, отримує наше значення - воно відповідає пізнішій дії користувача.
+    """
+    merged = {}
+    for path, value in (fields or {}).items():
+        if base is not None and path in base:
+            theirs = get_path(current, path)
+            if theirs != base[path] and value == base[path]:
+                continue
+        merged[path] = value
+    return merged
+
+def execute_user_fields_update(cur, user_id, fields=None, increments=None, expected_version=None):
+    """Виконує UPDATE з ланцюжком jsonb_set у межах переданого курсора
+
+    Повертає нову версію документа або None, якщо рядка немає чи версія вже не expected_version
+    """
+    expr = "data"
+    params = []
+    
+    for path, value in (fields or {}).items():
+        expr = f"jsonb_set({expr}, %s, %s)"
+        params += [list(path), Json(value)]
+    
+    for path, delta in (increments or {}).items():
+        expr = f"jsonb_set({expr}, %s, to_jsonb(COALESCE((data #>> %s)::numeric, 0) + %s))"
+        params += [list(path), list(path), delta]
+    
+    if not params:
+        return expected_version
+    
+    query = f"UPDATE users SET data = {expr}, version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE user_id = %s"
+    params.append(str(user_id))
+    if expected_version is not None:
+        query += " AND version = %s"
+        params.append(expected_version)
+    cur.execute(query + " RETURNING version", params)
+    row = cur.fetchone()
+    return row[0] if row else None
+
+# Нагадування
+def next_fire_time(remind_time, now):
+    """Найближчий момент HH:MM, що настає після now"""
+    hour, minute = map(int, remind_time.split(':'))
+    fire_at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if fire_at <= now:
+        fire_at += timedelta(days=1)
+    return fire_at
+
+def set_reminder(user_id, remind_time):
+    try:
+        with db_cursor() as cur:
+            cur.execute("""
+                INSERT INTO reminders (user_id, remind_time, next_fire_at)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (user_id)
+                DO UPDATE SET remind_time = EXCLUDED.remind_time, next_fire_at = EXCLUDED.next_fire_at
+            """, (user_id, remind_time, next_fire_time(remind_time, datetime.now())))
+    except Exception as e:
+        logger.error(f"Error setting reminder: {e}")
+
+def clear_reminder(user_id):
+    try:
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM reminders WHERE user_id = %s", (user_id,))
+    except Exception as e:
+        logger.error(f"Error clearing reminder: {e}")
+
+def claim_due_reminders(now, limit):
+    """Переносить нагадування, час яких настав, на наступний день і повертає їх.
+
+    Нагадування позначається відправленим ще до відправки, тому навіть після
+    збою чи перезапуску воно не буде надіслане двічі.
+    """
+    try:
+        with db_cursor() as cur:
+            cur.execute("""
+                UPDATE reminders r
+                SET next_fire_at = CASE
+                        WHEN %(today)s + r.remind_time > %(now)s THEN %(today)s + r.remind_time
+                        ELSE %(today)s + 1 + r.remind_time
+                    END,
+                    last_sent_at = %(now)s
+                FROM (
+                    SELECT user_id, next_fire_at FROM reminders
+                    WHERE next_fire_at <= %(now)s
+                    ORDER BY next_fire_at
+                    LIMIT %(limit)s
+                    FOR UPDATE SKIP LOCKED
+                ) due
+                WHERE r.user_id = due.user_id
+                RETURNING r.user_id, due.next_fire_at
+            """, {'now': now, 'today': now.date(), 'limit': limit})
+            return cur.fetchall()
     except Exception as e:
-        logger.error(f"Error getting all users: {e}")
+        logger.error(f"Error claiming due reminders: {e}")
+        return []
+
+# Картки
+CARD_COLUMNS = (
+    "id, ukrainian, english, added_date, next_review, interval, "
+    "ease, reps, lapses, stability, difficulty, last_review"
+)
+
+class Card:
+    """Картка слова в пам'яті; added_at, next_review і last_review - секунди epoch"""
+    __slots__ = (
+        'id', 'ukrainian', 'english', 'added_at', 'next_review', 'interval',
+        'ease', 'reps', 'lapses', 'stability', 'difficulty', 'last_review'
+    )
+
+    def __init__(self, ukrainian, english, added_at=None, next_review=None, interval=1, id=None,
+                 ease=2.5, reps=0, lapses=0, stability=None, difficulty=None, last_review=None):
+        now = int(time.time())
+        self.id = id
+        self.ukrainian = ukrainian
+        self.english = english
+        self.added_at = now if added_at is None else added_at
+        self.next_review = now if next_review is None else next_review
+        self.interval = interval
+        self.ease = ease
+        self.reps = reps
+        self.lapses = lapses
+        self.stability = stability
+        self.difficulty = difficulty
+        self.last_review = last_review
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            row['ukrainian'],
+            row['english'],
+            int(row['added_date'].timestamp()),
+            int(row['next_review'].timestamp()),
+            row['interval'],
+            row['id'],
+            row['ease'],
+            row['reps'],
+            row['lapses'],
+            row['stability'],
+            row['difficulty'],
+            int(row['last_review'].timestamp()) if row['last_review'] else None
+        )
+
+    def schedule_values(self):
+        """Стан розкладу для UPDATE cards (next_review, interval, ease, reps, lapses, stability, difficulty, last_review)"""
+        return (
+            datetime.fromtimestamp(self.next_review),
+            self.interval,
+            self.ease,
+            self.reps,
+            self.lapses,
+            self.stability,
+            self.difficulty,
+            datetime.fromtimestamp(self.last_review) if self.last_review is not None else None
+        )
+
+    @classmethod
+    def from_legacy(cls, data):
+        """Картка зі старого JSONB документа (повні ключі, дати ISO-8601)"""
+        def epoch(value):
+            return int(datetime.fromisoformat(value).timestamp()) if value else None
+        
+        return cls(
+            data['ukrainian'],
+            data['english'],
+            epoch(data.get('added_date')),
+            epoch(data.get('next_review')),
+            data.get('interval', 1)
+        )
+
+def card_values(user_id, card):
+    """Рядок для INSERT INTO cards (user_id, ukrainian, english, added_date, next_review, interval)"""
+    return (
+        str(user_id),
+        card.ukrainian,
+        card.english,
+        datetime.fromtimestamp(card.added_at),
+        datetime.fromtimestamp(card.next_review),
+        card.interval
+    )
+
+# Інтервальне повторення
+AGAIN, HARD, GOOD, EASY = 1, 2, 3, 4
+DAY = 86400
+# Швидкий режим лише показує слова - вони повертаються через фіксований термін
+FAST_REVIEW_POSTPONE_DAYS = 2
+MAX_INTERVAL_DAYS = 36500
+SRS_DEFAULT_SCHEDULER = os.getenv("SRS_DEFAULT_SCHEDULER", "sm2")
+SRS_DESIRED_RETENTION = float(os.getenv("SRS_DESIRED_RETENTION", "0.9"))
+
+class SM2Scheduler:
+    """Класичний SM-2: коефіцієнт легкості і зростаючий інтервал"""
+    name = 'sm2'
+    title = 'SM-2'
+    # Оцінки 1-4 у шкалі якості SM-2 (0-5)
+    QUALITY = {AGAIN: 1, HARD: 3, GOOD: 4, EASY: 5}
+
+    def update(self, card, grade):
+        """Оновлює стан SM-2 і повертає інтервал у днях"""
+        q = self.QUALITY[grade]
+        if q < 3:
+            card.reps = 0
+            card.lapses += 1
+            card.interval = 1
+        else:
+            card.reps += 1
+            if card.reps == 1:
+                card.interval = 1
+            elif card.reps == 2:
+                card.interval = 6
+            else:
+                card.interval = min(round(card.interval * card.ease), MAX_INTERVAL_DAYS)
+        card.ease = max(1.3, card.ease + 0.1 - (5 - q) * (0.08 + (5 - q) * 0.02))
+        return card.interval
+
+    def intervals(self, interval, stability):
+        """Інтервали в днях для масивів стану карток"""
+        return interval
+
+class FSRSScheduler:
+    """FSRS (v4.5): модель пам'яті зі стабільністю і складністю картки"""
+    name = 'fsrs'
+    title = 'FSRS'
+    W = (0.4872, 1.4003, 3.7145, 13.8206, 5.1618, 1.2298, 0.8975, 0.031, 1.6474,
+         0.1367, 1.0461, 2.1072, 0.0793, 0.3246, 1.587, 0.2272, 2.8755)
+    DECAY = -0.5
+    FACTOR = 19 / 81
+
+    def __init__(self, retention):
+        self.retention = retention
+        # Інтервал, після якого ймовірність згадати падає до retention, дорівнює stability * k
+        self.k = (retention ** (1 / self.DECAY) - 1) / self.FACTOR
+
+    def init_difficulty(self, grade):
+        return min(max(self.W[4] - (grade - 3) * self.W[5], 1), 10)
+
+    def update(self, card, grade, now):
+        """Оновлює стан FSRS і повертає інтервал у днях"""
+        w = self.W
+        if card.stability is None or card.last_review is None:
+            card.stability = w[grade - 1]
+            card.difficulty = self.init_difficulty(grade)
+        else:
+            elapsed = max(now - card.last_review, 0) / DAY
+            r = (1 + self.FACTOR * elapsed / card.stability) ** self.DECAY
+            d, s = card.difficulty, card.stability
+            if grade == AGAIN:
+                card.stability = w[11] * d ** -w[12] * ((s + 1) ** w[13] - 1) * math.exp(w[14] * (1 - r))
+            else:
+                hard_penalty = w[15] if grade == HARD else 1
+                easy_bonus = w[16] if grade == EASY else 1
+                card.stability = s * (1 + math.exp(w[8]) * (11 - d) * s ** -w[9]
+                                      * (math.exp(w[10] * (1 - r)) - 1) * hard_penalty * easy_bonus)
+            d = d - w[6] * (grade - 3)
+            card.difficulty = min(max(w[7] * self.init_difficulty(GOOD) + (1 - w[7]) * d, 1), 10)
+        return int(min(max(round(card.stability * self.k), 1), MAX_INTERVAL_DAYS))
+
+    def intervals(self, interval, stability):
+        return np.clip(np.rint(stability * self.k), 1, MAX_INTERVAL_DAYS)
+
+SCHEDULERS = {
+    scheduler.name: scheduler
+    for scheduler in (SM2Scheduler(), FSRSScheduler(SRS_DESIRED_RETENTION))
+}
+
+def get_scheduler(data):
+    """Алгоритм повторення, вибраний користувачем"""
+    return SCHEDULERS.get(data.get('scheduler'), SCHEDULERS[SRS_DEFAULT_SCHEDULER])
+
+def review_card(card, grade, scheduler, now=None):
+    """Застосовує відповідь до картки: оновлює стан обох алгоритмів, розклад - за вибраним.
+
+    Стан іншого алгоритму теж ведеться, щоб при перемиканні розклад можна було одразу перерахувати.
+    """
+    now = int(time.time()) if now is None else now
+    sm2_days = SCHEDULERS['sm2'].update(card, grade)
+    fsrs_days = SCHEDULERS['fsrs'].update(card, grade, now)
+    days = sm2_days if scheduler.name == 'sm2' else fsrs_days
+    
+    card.last_review = now
+    card.next_review = now + days * DAY
+    return days
+
+def postpone_card(card, days, now=None):
+    """Відкладає картку на фіксовану кількість днів, не змінюючи стан SM-2/FSRS (перегляд без перевірки)"""
+    now = int(time.time()) if now is None else now
+    card.next_review = now + days * DAY
+
+def recompute_next_reviews(scheduler, last_review, interval, stability, next_review):
+    """Векторний перерахунок next_review (секунди epoch) для масивів стану карток.
+
+    Картки без жодного повторення (last_review = NaN) зберігають поточний next_review.
+    """
+    reviewed = ~np.isnan(last_review)
+    days = scheduler.intervals(interval, np.where(reviewed, stability, 1.0))
+    return np.where(reviewed, last_review + days * DAY, next_review)
+
+def load_cards(user_id, limit=None):
+    """Повертає картки користувача в порядку додавання"""
+    try:
+        with db_cursor(RealDictCursor) as cur:
+            cur.execute(
+                f"SELECT {CARD_COLUMNS} FROM cards WHERE user_id = %s ORDER BY id LIMIT %s",
+                (str(user_id), limit)
+            )
+            return [Card.from_row(row) for row in cur.fetchall()]
+    except Exception as e:
+        logger.error(f"Error loading cards: {e}")
+        return []
+
+def load_due_cards(user_id):
+    """Повертає картки, час повторення яких настав (через індекс user_id, next_review)"""
+    try:
+        with db_cursor(RealDictCursor) as cur:
+            cur.execute(
+                f"SELECT {CARD_COLUMNS} FROM cards WHERE user_id = %s AND next_review <= %s ORDER BY next_review, id",
+                (str(user_id), datetime.now())
+            )
+            return [Card.from_row(row) for row in cur.fetchall()]
+    except Exception as e:
+        logger.error(f"Error loading due cards: {e}")
+        return []
+
+def count_cards(user_id):
+    """Повертає (всього карток, карток до повторення)"""
+    return count_cards_batch([user_id]).get(str(user_id), (0, 0))
+
+def count_cards_batch(user_ids):
+    """Повертає {user_id: (всього карток, карток до повторення)} одним запитом"""
+    user_ids = [str(user_id) for user_id in user_ids]
+    try:
+        with db_cursor() as cur:
+            cur.execute("""
+                SELECT user_id, count(*), count(*) FILTER (WHERE next_review <= %s)
+                FROM cards WHERE user_id = ANY(%s)
+                GROUP BY user_id
+            """, (datetime.now(), user_ids))
+            counts = {user_id: (total, due) for user_id, total, due in cur.fetchall()}
+        return {user_id: counts.get(user_id, (0, 0)) for user_id in user_ids}
+    except Exception as e:
+        logger.error(f"Error counting cards: {e}")
         return {}
 
+def sample_cards(user_id, limit, exclude_id=None):
+    """Повертає випадкові картки (варіанти відповідей для вікторини)"""
+    try:
+        with db_cursor(RealDictCursor) as cur:
+            cur.execute(
+                f"SELECT {CARD_COLUMNS} FROM cards WHERE user_id = %s AND id IS DISTINCT FROM %s ORDER BY random() LIMIT %s",
+                (str(user_id), exclude_id, limit)
+            )
+            return [Card.from_row(row) for row in cur.fetchall()]
+    except Exception as e:
+        logger.error(f"Error sampling cards: {e}")
+        return []
+
+def add_cards(user_id, cards):
+    """Додає картки, пропускаючи слова що вже є у словнику. Повертає кількість доданих"""
+    if not cards:
+        return 0
+    try:
+        with db_cursor() as cur:
+            rows = [card_values(user_id, card) for card in cards]
+            inserted = execute_values(cur, """
+                INSERT INTO cards (user_id, ukrainian, english, added_date, next_review, interval)
+                VALUES %s
+                ON CONFLICT (user_id, (lower(english))) DO NOTHING
+                RETURNING id
+            """, rows, fetch=True)
+            return len(inserted)
+    except Exception as e:
+        logger.error(f"Error adding cards: {e}")
+        return 0
+
+def commit_review_batch(user_id, reviews, increments=None):
+    """Записує відповіді сесії повторення і лічильники статистики однією транзакцією
+
+    reviews - {id картки: Card.schedule_values()}. Якщо картку тим часом повторили
+    пізніше (інша сесія чи воркер), її новіший розклад не перетирається.
+    """
+    try:
+        with db_cursor() as cur:
+            if reviews:
+                execute_values(cur, """
+                    UPDATE cards SET
+                        next_review = v.next_review, interval = v.interval, ease = v.ease, reps = v.reps,
+                        lapses = v.lapses, stability = v.stability, difficulty = v.difficulty,
+                        last_review = v.last_review
+                    FROM (VALUES %s) AS v (
+                        id, user_id, next_review, interval, ease, reps, lapses, stability, difficulty, last_review
+                    )
+                    WHERE cards.id = v.id AND cards.user_id = v.user_id
+                        AND (cards.last_review IS NULL OR cards.last_review <= v.last_review)
+                """, [(card_id, str(user_id)) + values for card_id, values in reviews.items()])
+            execute_user_fields_update(cur, user_id, increments=increments)
+        return True
+    except Exception as e:
+        logger.error(f"Error committing review batch: {e}")
+        return False
+
+def recompute_schedules(user_id, scheduler):
+    """Перераховує next_review усіх карток користувача одним векторним проходом. Повертає кількість"""
+    try:
+        with db_cursor() as cur:
+            cur.execute("""
+                SELECT id, next_review, interval, stability, last_review
+                FROM cards WHERE user_id = %s
+                FOR UPDATE
+            """, (str(user_id),))
+            rows = cur.fetchall()
+            if not rows:
+                return 0
+            
+            ids, next_review, interval, stability, last_review = zip(*rows)
+            nan = float('nan')
+            next_epochs = recompute_next_reviews(
+                scheduler,
+                np.array([ts.timestamp() if ts else nan for ts in last_review]),
+                np.array(interval, dtype=float),
+                np.array([nan if s is None else s for s in stability]),
+                np.array([ts.timestamp() for ts in next_review])
+            )
+            
+            execute_values(cur, """
+                UPDATE cards SET next_review = v.next_review
+                FROM (VALUES %s) AS v (id, next_review)
+                WHERE cards.id = v.id
+            """, [(card_id, datetime.fromtimestamp(epoch)) for card_id, epoch in zip(ids, next_epochs.tolist())])
+            return len(ids)
+    except Exception as e:
+        logger.error(f"Error recomputing schedules: {e}")
+        return 0
+
+def delete_card(user_id, card_id):
+    """Видаляє картку"""
+    try:
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM cards WHERE id = %s AND user_id = %s", (card_id, str(user_id)))
+    except Exception as e:
+        logger.error(f"Error deleting card: {e}")
+
+# Збережені переклади
+def load_cached_translation(source_text, source_lang, target_lang, max_age):
+    """Повертає збережений переклад, якщо він не старший за max_age секунд"""
+    try:
+        with db_cursor() as cur:
+            cur.execute("""
+                SELECT translation FROM translations
+                WHERE source_lang = %s AND target_lang = %s AND source_text = %s AND created_at > %s
+            """, (source_lang, target_lang, source_text, datetime.now() - timedelta(seconds=max_age)))
+            row = cur.fetchone()
+            return row[0] if row else None
+    except Exception as e:
+        logger.error(f"Error loading cached translation: {e}")
+        return None
+
+def save_cached_translation(source_text, source_lang, target_lang, translation):
+    try:
+        with db_cursor() as cur:
+            cur.execute("""
+                INSERT INTO translations (source_text, source_lang, target_lang, translation, created_at)
+                VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
+                ON CONFLICT (source_lang, target_lang, source_text)
+                DO UPDATE SET translation = EXCLUDED.translation, created_at = CURRENT_TIMESTAMP
+            """, (source_text, source_lang, target_lang, translation))
+    except Exception as e:
+        logger.error(f"Error saving cached translation: {e}")
+
+# Збережені приклади Reverso (порожній список - слово без прикладів)
+def load_cached_examples(word, source_lang, target_lang):
+    """Повертає (приклади, час збереження) або None"""
+    try:
+        with db_cursor() as cur:
+            cur.execute("""
+                SELECT examples, created_at FROM examples
+                WHERE source_lang = %s AND target_lang = %s AND word = %s
+            """, (source_lang, target_lang, word))
+            return cur.fetchone()
+    except Exception as e:
+        logger.error(f"Error loading cached examples: {e}")
+        return None
+
+def save_cached_examples(word, source_lang, target_lang, examples):
+    try:
+        with db_cursor() as cur:
+            cur.execute("""
+                INSERT INTO examples (word, source_lang, target_lang, examples, created_at)
+                VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
+                ON CONFLICT (source_lang, target_lang, word)
+                DO UPDATE SET examples = EXCLUDED.examples, created_at = CURRENT_TIMESTAMP
+            """, (word, source_lang, target_lang, Json(examples)))
+    except Exception as e:
+        logger.error(f"Error saving cached examples: {e}")
+
+# Асинхронний доступ до БД через окремий пул потоків
+# Потоків стільки ж, скільки з'єднань у пулі - запити не чекають на вільне з'єднання
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX_SIZE, thread_name_prefix="db")
+
+async def run_db(func, *args):
+    """Виконує синхронну функцію БД без блокування event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, partial(func, *args))
+
+async def load_user_data_async(user_id):
+    """Повертає (data, version); документ з кешу - без версії"""
+    if user_cache is not None:
+        data = user_cache.get(user_id)
+        if data is not None:
+            return data, None
+    
+    data, version = await run_db(load_user_data, user_id)
+    
+    if user_cache is not None and data is not None:
+        data = user_cache.put(user_id, data)
+    return data, version
+
+async def save_user_data_async(user_id, data):
+    version = await run_db(save_user_data, user_id, data)
+    if user_cache is not None and version is not None:
+        user_cache.put(user_id, data)
+    return version
+
+async def set_reminder_async(user_id, remind_time):
+    await run_db(set_reminder, user_id, remind_time)
+
+async def clear_reminder_async(user_id):
+    await run_db(clear_reminder, user_id)
+
+async def claim_due_reminders_async(now, limit):
+    return await run_db(claim_due_reminders, now, limit)
+
+async def update_user_fields_async(user_id, fields=None, increments=None, expected_version=None, base=None):
+    if user_cache is not None:
+        # Запис відкладається і об'єднується з іншими змінами цього користувача
+        user_cache.patch(user_id, fields, increments)
+        return
+    await run_db(update_user_fields, user_id, fields, increments, expected_version, base)
+
+async def load_cards_async(user_id, limit=None):
+    return await run_db(load_cards, user_id, limit)
+
+async def load_due_cards_async(user_id):
+    return await run_db(load_due_cards, user_id)
+
+async def count_cards_async(user_id):
+    # Відповіді, що ще чекають у пакеті, мають рахуватись як уже повторені
+    await review_batcher.flush(user_id)
+    return await run_db(count_cards, user_id)
+
+async def count_cards_batch_async(user_ids):
+    return await run_db(count_cards_batch, user_ids)
+
+async def sample_cards_async(user_id, limit, exclude_id=None):
+    return await run_db(sample_cards, user_id, limit, exclude_id)
+
+async def add_cards_async(user_id, cards):
+    return await run_db(add_cards, user_id, cards)
+
+async def commit_review_batch_async(user_id, reviews, increments=None):
+    return await run_db(commit_review_batch, user_id, reviews, increments)
+
+async def recompute_schedules_async(user_id, scheduler):
+    return await run_db(recompute_schedules, user_id, scheduler)
+
+async def delete_card_async(user_id, card_id):
+    await run_db(delete_card, user_id, card_id)
+
+# Блокуючі мережеві запити (переклад) і розбір HTML виконуються поза event loop
+NETWORK_WORKERS = int(os.getenv("NETWORK_WORKERS", "16"))
+network_executor = ThreadPoolExecutor(max_workers=NETWORK_WORKERS, thread_name_prefix="net")
+
+async def run_network(func, *args):
+    """Виконує блокуючий мережевий виклик в окремому пулі потоків"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(network_executor, partial(func, *args))
+
+# Спільний HTTP клієнт для Reverso і Anthropic
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "50"))
+HTTP_MAX_PER_HOST = int(os.getenv("HTTP_MAX_PER_HOST", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))
+HTTP_MAX_RETRY_AFTER = float(os.getenv("HTTP_MAX_RETRY_AFTER", "10"))
+
+# Базові адреси можна перевизначити (наприклад, на локальний тестовий сервер)
+REVERSO_BASE_URL = os.getenv("REVERSO_BASE_URL", "https://context.reverso.net")
+ANTHROPIC_BASE_URL = os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com")
+
+class HttpClient:
+    """Пул keep-alive з'єднань з лімітом на хост, таймаутами і повторами"""
+
+    # Статуси, після яких запит варто повторити
+    RETRY_STATUSES = {429, 500, 502, 503, 504, 529}
+    # Помилки, коли запит точно не дійшов до сервера або з'єднання застаріло
+    RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.RemoteProtocolError)
+
+    def __init__(self, timeout, connect_timeout, max_connections, max_per_host,
+                 keepalive_expiry, retries, backoff, max_retry_after):
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.max_per_host = max_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.max_retry_after = max_retry_after
+        self._client = None
+        self._host_slots = {}
+
+    @property
+    def client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits, follow_redirects=True)
+        return self._client
+
+    def _slots(self, url):
+        """Семафор, що обмежує кількість одночасних запитів до одного хоста"""
+        host = httpx.URL(url).host
+        slots = self._host_slots.get(host)
+        if slots is None:
+            slots = self._host_slots[host] = asyncio.Semaphore(self.max_per_host)
+        return slots
+
+    def _retry_delay(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.headers.get("retry-after")
+            if retry_after:
+                try:
+                    return min(float(retry_after), self.max_retry_after)
+                except ValueError:
+                    pass
+        return self.backoff * (2 ** attempt)
+
+    async def request(self, method, url, **kwargs):
+        """Виконує запит, повторюючи його при збоях з'єднання і 429/5xx"""
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._slots(url):
+                    response = await self.client.request(method, url, **kwargs)
+            except self.RETRY_ERRORS as e:
+                if attempt == self.retries:
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning(f"{method} {url} failed ({e!r}), retrying in {delay:.1f}s")
+            else:
+                if response.status_code not in self.RETRY_STATUSES or attempt == self.retries:
+                    return response
+                delay = self._retry_delay(attempt, response)
+                logger.warning(f"{method} {url} returned {response.status_code}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def stream(self, method, url, **kwargs):
+        """Потоковий запит; повторюється лише доки відповідь не почали читати"""
+        for attempt in range(self.retries + 1):
+            started = False
+            try:
+                async with self._slots(url):
+                    async with self.client.stream(method, url, **kwargs) as response:
+                        if response.status_code not in self.RETRY_STATUSES or attempt == self.retries:
+                            started = True
+                            yield response
+                            return
+                        delay = self._retry_delay(attempt, response)
+                        logger.warning(f"{method} {url} returned {response.status_code}, retrying in {delay:.1f}s")
+            except self.RETRY_ERRORS as e:
+                if started or attempt == self.retries:
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning(f"{method} {url} failed ({e!r}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+http_client = HttpClient(
+    HTTP_TIMEOUT, HTTP_CONNECT_TIMEOUT, HTTP_MAX_CONNECTIONS, HTTP_MAX_PER_HOST,
+    HTTP_KEEPALIVE_EXPIRY, HTTP_RETRIES, HTTP_RETRY_BACKOFF, HTTP_MAX_RETRY_AFTER,
+)
+
+# Кеш документів користувачів у пам'яті процесу з відкладеним записом
+USER_CACHE_ENABLED = os.getenv("USER_CACHE_ENABLED", "0") == "1"
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
+USER_CACHE_MAX_BYTES = int(os.getenv("USER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+USER_CACHE_FLUSH_INTERVAL = float(os.getenv("USER_CACHE_FLUSH_INTERVAL", "2"))
+# Після стількох невдалих записів поспіль зміни користувача відкидаються
+USER_CACHE_MAX_FLUSH_FAILURES = int(os.getenv("USER_CACHE_MAX_FLUSH_FAILURES", "5"))
+
+class CachedUser:
+    __slots__ = ('data', 'loaded_at', 'size', 'fields', 'increments', 'flushing', 'failures', 'retry_at')
+
+    def __init__(self):
+        self.data = None
+        self.loaded_at = 0.0
+        self.size = 0
+        self.fields = {}
+        self.increments = {}
+        self.flushing = False
+        self.failures = 0
+        self.retry_at = 0.0
+
+    @property
+    def dirty(self):
+        return bool(self.fields or self.increments) or self.flushing
+
+class UserCache:
+    """LRU-кеш з TTL і лімітом пам'яті; зміни збираються і записуються пачкою"""
+
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+    def _entry(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None:
+            entry = self.entries[user_id] = CachedUser()
+        self.entries.move_to_end(user_id)
+        return entry
+
+    def _resize(self, entry):
+        self.total_bytes -= entry.size
+        entry.size = len(json.dumps(entry.data, default=str)) if entry.data is not None else 0
+        self.total_bytes += entry.size
+
+    def _evict(self):
+        """Викидає найдавніші чисті записи поки кеш більший за ліміти"""
+        for user_id in list(self.entries):
+            if len(self.entries) <= self.max_entries and self.total_bytes <= self.max_bytes:
+                break
+            entry = self.entries[user_id]
+            if not entry.dirty:
+                self.total_bytes -= entry.size
+                del self.entries[user_id]
+
+    def get(self, user_id):
+        entry = self.entries.get(str(user_id))
+        if entry is None or entry.data is None:
+            return None
+        if time.monotonic() - entry.loaded_at > self.ttl:
+            # Застарілий документ перечитується з БД, незаписані зміни лишаються
+            entry.data = None
+            self._resize(entry)
+            return None
+        self.entries.move_to_end(str(user_id))
+        return copy.deepcopy(entry.data)
+
+    def put(self, user_id, data):
+        """Кладе свіжо прочитаний документ і накладає на нього ще не записані зміни"""
+        entry = self._entry(str(user_id))
+        entry.data = copy.deepcopy(data)
+        entry.loaded_at = time.monotonic()
+        for path, value in entry.fields.items():
+            set_path(entry.data, path, value)
+        for path, delta in entry.increments.items():
+            set_path(entry.data, path, get_path(entry.data, path, 0) + delta)
+        self._resize(entry)
+        self._evict()
+        return copy.deepcopy(entry.data)
+
+    def patch(self, user_id, fields=None, increments=None):
+        entry = self._entry(str(user_id))
+        for path, value in (fields or {}).items():
+            entry.fields[path] = value
+            if entry.data is not None:
+                set_path(entry.data, path, value)
+        for path, delta in (increments or {}).items():
+            entry.increments[path] = entry.increments.get(path, 0) + delta
+            if entry.data is not None:
+                set_path(entry.data, path, get_path(entry.data, path, 0) + delta)
+        self._resize(entry)
+
+    async def flush(self, force=False):
+        """Записує накопичені зміни - один UPDATE на користувача
+
+        Невдалий запис повторюється з експоненційною затримкою (force - без неї, при зупинці)
+        """
+        now = time.monotonic()
+        for user_id, entry in list(self.entries.items()):
+            if not (entry.fields or entry.increments):
+                continue
+            if not force and entry.retry_at > now:
+                continue
+            fields, increments = entry.fields, entry.increments
+            entry.fields, entry.increments = {}, {}
+            
+            entry.flushing = True
+            try:
+                written = await run_db(update_user_fields, user_id, fields, increments)
+            finally:
+                entry.flushing = False
+            
+            if written:
+                entry.failures = 0
+                continue
+            if written is None:
+                logger.warning(f"User {user_id} not found, dropping cached changes: {fields} {increments}")
+                continue
+            
+            entry.failures += 1
+            if entry.failures >= USER_CACHE_MAX_FLUSH_FAILURES:
+                logger.error(f"Dropping cached changes of user {user_id} after {entry.failures} failed writes: {fields} {increments}")
+                entry.failures, entry.retry_at = 0, 0.0
+                continue
+            entry.retry_at = now + USER_CACHE_FLUSH_INTERVAL * 2 ** entry.failures
+            # Повертаємо зміни назад, нові значення полів мають пріоритет
+            entry.fields = {**fields, **entry.fields}
+            for path, delta in increments.items():
+                entry.increments[path] = entry.increments.get(path, 0) + delta
+        self._evict()
+
+    async def run_flusher(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"User cache flush error: {e}")
+
+user_cache = UserCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_MAX_BYTES, USER_CACHE_TTL) if USER_CACHE_ENABLED else None
+
+# Відповіді в сесіях повторення записуються пачками
+REVIEW_BATCH_SIZE = int(os.getenv("REVIEW_BATCH_SIZE", "10"))
+REVIEW_IDLE_TIMEOUT = float(os.getenv("REVIEW_IDLE_TIMEOUT", "30"))
+REVIEW_FLUSH_INTERVAL = float(os.getenv("REVIEW_FLUSH_INTERVAL", "5"))
+
+class PendingReviews:
+    __slots__ = ('reviews', 'increments', 'updated_at')
+
+    def __init__(self):
+        self.reviews = {}
+        self.increments = {}
+        self.updated_at = time.monotonic()
+
+class ReviewBatcher:
+    """Накопичує відповіді сесій повторення і записує їх однією транзакцією.
+
+    Пачка записується кожні batch_size відповідей (контрольна точка), в кінці
+    сесії або після idle_timeout без відповідей, тож при збої втрачається
+    не більше однієї незаписаної пачки.
+    """
+
+    def __init__(self, batch_size, idle_timeout):
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self.pending = {}
+
+    async def record(self, user_id, card, grade, scheduler, increments=None):
+        """Застосовує оцінку (AGAIN/HARD/GOOD/EASY) до картки і запам'ятовує новий розклад"""
+        review_card(card, grade, scheduler)
+        await self._add(str(user_id), card, increments)
+
+    async def postpone(self, user_id, card, days, increments=None):
+        """Відкладає картку на days днів без оцінки - стан алгоритмів не змінюється"""
+        postpone_card(card, days)
+        await self._add(str(user_id), card, increments)
+
+    async def _add(self, user_id, card, increments):
+        pending = self.pending.get(user_id)
+        if pending is None:
+            pending = self.pending[user_id] = PendingReviews()
+        pending.reviews[card.id] = card.schedule_values()
+        for path, delta in (increments or {}).items():
+            pending.increments[path] = pending.increments.get(path, 0) + delta
+        pending.updated_at = time.monotonic()
+        
+        if len(pending.reviews) >= self.batch_size:
+            await self.flush(user_id)
+
+    async def flush(self, user_id):
+        user_id = str(user_id)
+        pending = self.pending.pop(user_id, None)
+        if pending is None:
+            return True
+        
+        # З кешем документів лічильники йдуть через кеш, щоб він не застарів
+        increments = pending.increments if user_cache is None else None
+        if not await commit_review_batch_async(user_id, pending.reviews, increments):
+            self._requeue(user_id, pending)
+            return False
+        
+        if user_cache is not None and pending.increments:
+            user_cache.patch(user_id, None, pending.increments)
+        return True
+
+    def _requeue(self, user_id, pending):
+        current = self.pending.get(user_id)
+        if current is None:
+            self.pending[user_id] = pending
+            return
+        # Новіші відповіді на ту саму картку мають пріоритет
+        for card_id, review in pending.reviews.items():
+            current.reviews.setdefault(card_id, review)
+        for path, delta in pending.increments.items():
+            current.increments[path] = current.increments.get(path, 0) + delta
+
+    async def flush_idle(self):
+        now = time.monotonic()
+        for user_id in [u for u, p in self.pending.items() if now - p.updated_at >= self.idle_timeout]:
+            await self.flush(user_id)
+
+    async def flush_all(self):
+        for user_id in list(self.pending):
+            await self.flush(user_id)
+
+    async def run_flusher(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush_idle()
+            except Exception as e:
+                logger.error(f"Review batch flush error: {e}")
+
+review_batcher = ReviewBatcher(REVIEW_BATCH_SIZE, REVIEW_IDLE_TIMEOUT)
+
 # Ініціалізація даних користувача
-def init_user(user_id):
+async def init_user(user_id):
+    """Повертає (data, version), створюючи документ для нового користувача"""
     user_id = str(user_id)
-    data = load_user_data(user_id)
+    data, version = await load_user_data_async(user_id)
     
     if data is None:
         data = {
-            'cards': [],
             'level': 'B1',
             'stats': {'total_reviews': 0, 'correct': 0, 'streak': 0},
             'target_language': 'en',
@@ -113,9 +1300,134 @@ def init_user(user_id):
             'course': None,
             'course_progress': 0
         }
-        save_user_data(user_id, data)
-    
-    return data
+        version = await save_user_data_async(user_id, data)
+        if version is None:
+            # Документ щойно створив паралельний апдейт чи інший воркер - беремо його
+            stored, version = await load_user_data_async(user_id)
+            if stored is not None:
+                data = stored
+    
+    return data, version
+
+# Одиниця роботи на один апдейт
+class UserUnitOfWork:
+    """Завантажує документ користувача один раз за апдейт і записує зміни одним запитом в кінці"""
+
+    def __init__(self, user_id):
+        self.user_id = str(user_id)
+        self.data = None
+        self.version = None
+        # Значення змінених полів у прочитаному документі - для злиття при конфлікті запису
+        self.base = {}
+        self.fields = {}
+        self.increments = {}
+
+    @property
+    def dirty(self):
+        return bool(self.fields or self.increments)
+
+    async def load(self):
+        if self.data is None:
+            self.data, self.version = await init_user(self.user_id)
+            # Зміни, зроблені до завантаження, мають бути видні в документі
+            for path, value in self.fields.items():
+                self.base.setdefault(path, copy.deepcopy(get_path(self.data, path)))
+                set_path(self.data, path, value)
+            for path, delta in self.increments.items():
+                set_path(self.data, path, get_path(self.data, path, 0) + delta)
+        return self.data
+
+    def set(self, fields):
+        """fields - {('reminders', 'time'): '20:00'}"""
+        for path, value in fields.items():
+            self.fields[path] = value
+            if self.data is not None:
+                self.base.setdefault(path, copy.deepcopy(get_path(self.data, path)))
+                set_path(self.data, path, value)
+
+    def increment(self, increments):
+        """increments - {('stats', 'correct'): 1}"""
+        for path, delta in increments.items():
+            self.increments[path] = self.increments.get(path, 0) + delta
+            if self.data is not None:
+                set_path(self.data, path, get_path(self.data, path, 0) + delta)
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        fields, increments = self.fields, self.increments
+        self.fields, self.increments = {}, {}
+        # Без прочитаного документа (version is None) поля записуються без перевірки версії
+        await update_user_fields_async(self.user_id, fields, increments, self.version, self.base)
+
+def get_path(doc, path, default=None):
+    for key in path:
+        if not isinstance(doc, dict) or key not in doc:
+            return default
+        doc = doc[key]
+    return doc
+
+def set_path(doc, path, value):
+    for key in path[:-1]:
+        doc = doc.setdefault(key, {})
+    doc[path[-1]] = value
+
+def unit_of_work(context, user_id):
+    """Повертає одиницю роботи поточного апдейту (CallbackContext створюється на кожен апдейт)"""
+    uow = getattr(context, 'unit_of_work', None)
+    if uow is None or uow.user_id != str(user_id):
+        uow = UserUnitOfWork(user_id)
+        context.unit_of_work = uow
+    return uow
+
+# Запис змін після обробки апдейту (група 1 - після основних обробників)
+async def flush_unit_of_work(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uow = getattr(context, 'unit_of_work', None)
+    if uow is not None:
+        await uow.flush()
+
+# Стан розмови: у кожного користувача активний щонайбільше один режим введення
+REVIEW_STATE_KEYS = (
+    'current_card_index', 'due_cards', 'review_scheduler', 'quiz_correct_count', 'typing_correct_count', 'reverse_correct_count'
+)
+STATE_KEYS = {
+    'add_word': ('custom_word_step', 'custom_word_ukrainian'),
+    'translate': (),
+    'dict_delete': (),
+    'scramble': ('scramble_word', 'scramble_translation'),
+    'guess': ('game_correct',),
+    'dialog': ('dialog_scenario', 'dialog_prompt', 'dialog_history', 'dialog_summary', 'dialog_summarizing'),
+    'review_classic': REVIEW_STATE_KEYS,
+    'review_quiz': REVIEW_STATE_KEYS + ('quiz_correct_answer',),
+    'review_fast': REVIEW_STATE_KEYS,
+    'review_typing': REVIEW_STATE_KEYS,
+    'review_reverse': REVIEW_STATE_KEYS + ('reverse_correct_answer',),
+}
+
+def get_state(context):
+    return context.user_data.get('state')
+
+def enter_state(context, state, **values):
+    """Переходить у новий стан, скидаючи дані попереднього"""
+    leave_state(context)
+    context.user_data['state'] = state
+    context.user_data.update(values)
+
+def leave_state(context, state=None):
+    """Виходить з поточного стану (або лише з state, якщо він ще активний)"""
+    current = context.user_data.get('state')
+    if current is None or (state is not None and current != state):
+        return
+    for key in STATE_KEYS[current]:
+        context.user_data.pop(key, None)
+    del context.user_data['state']
+
+async def review_session_active(query, context, mode):
+    """Кнопка зі старого повідомлення повторення: сесію могли завершити чи замінити іншим режимом"""
+    if get_state(context) == f'review_{mode}':
+        return True
+    await query.edit_message_text("⏹ Цю сесію повторення вже завершено.\n\nПочніть нову: 📚 Повторити")
+    return False
 
 # Головне меню
 def get_main_menu():
@@ -324,10 +1636,7 @@ async def start_dialog(query, scenario, context):
     
     scenario_info = scenarios.get(scenario, scenarios['free'])
     
-    context.user_data['dialog_active'] = True
-    context.user_data['dialog_scenario'] = scenario
-    context.user_data['dialog_prompt'] = scenario_info['prompt']
-    context.user_data['dialog_history'] = []
+    enter_state(context, 'dialog', dialog_scenario=scenario, dialog_prompt=scenario_info['prompt'], dialog_history=[])
     
     await query.edit_message_text(
         f"💬 **{scenario_info['name']}**\n\n"
@@ -335,9 +1644,158 @@ async def start_dialog(query, scenario, context):
         f"💡 Відповідайте англійською. Я виправлю помилки!"
     )
 
+# Потокова відповідь AI в діалозі
+DIALOG_MODEL = os.getenv("DIALOG_MODEL", "claude-sonnet-4-20250514")
+DIALOG_READ_TIMEOUT = float(os.getenv("DIALOG_READ_TIMEOUT", "30"))
+DIALOG_EDIT_INTERVAL = float(os.getenv("DIALOG_EDIT_INTERVAL", "1.0"))
+
+# Бюджет токенів на історію; старіші репліки згортаються в підсумок
+DIALOG_HISTORY_TOKENS = int(os.getenv("DIALOG_HISTORY_TOKENS", "1500"))
+DIALOG_SUMMARY_MAX_TOKENS = int(os.getenv("DIALOG_SUMMARY_MAX_TOKENS", "200"))
+
+DIALOG_INSTRUCTIONS = (
+    "Respond naturally in English (2-3 sentences). If the user made grammar or vocabulary mistakes, "
+    "gently correct them at the end like: '✏️ Small correction: ...'"
+)
+
+def anthropic_headers():
+    return {
+        "Content-Type": "application/json",
+        "x-api-key": os.getenv("ANTHROPIC_API_KEY", ""),
+        "anthropic-version": "2023-06-01"
+    }
+
+def estimate_tokens(text):
+    """Груба оцінка кількості токенів (~4 символи на токен)"""
+    return len(text) // 4 + 1
+
+def history_tokens(history):
+    return sum(estimate_tokens(msg['content']) + 4 for msg in history)
+
+def trim_dialog_history(history, budget):
+    """Індекс, з якого найновіші репліки вміщаються в бюджет токенів"""
+    used = 0
+    start = len(history)
+    while start > 0:
+        cost = estimate_tokens(history[start - 1]['content']) + 4
+        # Останню репліку надсилаємо завжди, навіть якщо вона більша за бюджет
+        if used + cost > budget and start < len(history):
+            break
+        used += cost
+        start -= 1
+    
+    # Розмова для API має починатися з репліки користувача
+    while start < len(history) - 1 and history[start]['role'] != 'user':
+        start += 1
+    return start
+
+def build_dialog_system(prompt, summary=None):
+    """Незмінний системний промпт (кешується) і підсумок старішої частини розмови"""
+    system = [{
+        "type": "text",
+        "text": f"{prompt}\n\n{DIALOG_INSTRUCTIONS}",
+        "cache_control": {"type": "ephemeral"}
+    }]
+    if summary:
+        system.append({"type": "text", "text": f"Summary of the earlier conversation: {summary}"})
+    return system
+
+def build_dialog_messages(history):
+    """Репліки для API; послідовні репліки однієї ролі склеюються"""
+    messages = []
+    for msg in history:
+        if messages and messages[-1]['role'] == msg['role']:
+            messages[-1]['content'] += "\n" + msg['content']
+        else:
+            messages.append({'role': msg['role'], 'content': msg['content']})
+    
+    # Маркер кешування на останній репліці: наступний хід перевикористає весь цей префікс
+    if messages:
+        messages[-1]['content'] = [{
+            "type": "text",
+            "text": messages[-1]['content'],
+            "cache_control": {"type": "ephemeral"}
+        }]
+    return messages
+
+async def summarize_dialog(user_data, history, count):
+    """Згортає перші count реплік історії в короткий підсумок"""
+    transcript = "\n".join(
+        f"{'User' if msg['role'] == 'user' else 'AI'}: {msg['content']}" for msg in history[:count]
+    )
+    previous = user_data.get('dialog_summary')
+    if previous:
+        transcript = f"Earlier summary: {previous}\n\n{transcript}"
+    
+    try:
+        # Підсумок - такий самий запит до AI, тож він теж займає слот загального ліміту
+        async with dialog_scheduler.slots:
+            response = await http_client.post(
+                f"{ANTHROPIC_BASE_URL}/v1/messages",
+                headers=anthropic_headers(),
+                json={
+                    "model": DIALOG_MODEL,
+                    "max_tokens": DIALOG_SUMMARY_MAX_TOKENS,
+                    "messages": [{
+                        "role": "user",
+                        "content": "Summarize this English practice conversation in 2-4 sentences. "
+                                   "Keep names, facts and the learner's recurring mistakes.\n\n" + transcript
+                    }]
+                },
+                timeout=httpx.Timeout(DIALOG_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+            )
+        if response.status_code != 200:
+            logger.warning(f"Dialog summary returned status {response.status_code}")
+            return
+        summary = response.json()['content'][0]['text'].strip()
+    except Exception as e:
+        logger.error(f"Dialog summary error: {e}")
+        return
+    finally:
+        user_data['dialog_summarizing'] = False
+    
+    # Діалог могли перезапустити, поки готувався підсумок
+    if user_data.get('dialog_history') is history:
+        user_data['dialog_summary'] = summary
+        del history[:count]
+
+async def stream_dialog_reply(payload):
+    """Читає SSE потік Anthropic і повертає текст фрагментами"""
+    async with http_client.stream(
+        "POST",
+        f"{ANTHROPIC_BASE_URL}/v1/messages",
+        headers=anthropic_headers(),
+        json={**payload, "stream": True},
+        timeout=httpx.Timeout(DIALOG_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    ) as response:
+        if response.status_code != 200:
+            await response.aread()
+            raise RuntimeError(f"Anthropic returned status {response.status_code}: {response.text[:200]}")
+        
+        async for line in response.aiter_lines():
+            # Нас цікавлять лише рядки data:, тип події дублюється в JSON
+            if not line.startswith("data:"):
+                continue
+            event = json.loads(line[5:])
+            event_type = event.get('type')
+            
+            if event_type == 'content_block_delta' and event['delta'].get('type') == 'text_delta':
+                yield event['delta']['text']
+            elif event_type == 'error':
+                raise RuntimeError(f"Anthropic stream error: {event.get('error')}")
+            elif event_type == 'message_stop':
+                return
+
+async def edit_dialog_message(message, text, reply_markup=None):
+    try:
+        await message.edit_text(text, reply_markup=reply_markup)
+    except Exception as e:
+        # "Message is not modified" і обмеження частоти редагувань не критичні
+        logger.debug(f"Dialog edit skipped: {e}")
+
 # Обробка відповіді в діалозі
-async def process_dialog_message(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message: str):
-    """Обробляє повідомлення користувача в діалозі"""
+async def process_dialog_message(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message: str, deadline=None):
+    """Обробляє повідомлення користувача в діалозі; deadline - крайній час першого слова"""
     
     user_id = str(update.effective_user.id)
     
@@ -352,63 +1810,165 @@ async def process_dialog_message(update: Update, context: ContextTypes.DEFAULT_T
     
     # Формуємо промпт для AI
     system_prompt = context.user_data.get('dialog_prompt', 'You are a helpful English conversation partner.')
+    history = context.user_data['dialog_history']
     
-    # Обмежуємо історію до останніх 10 повідомлень
-    recent_history = context.user_data['dialog_history'][-10:]
+    # Надсилаємо найновіші репліки в межах бюджету, решту покриває підсумок
+    start = trim_dialog_history(history, DIALOG_HISTORY_TOKENS)
     
-    # Створюємо повідомлення для AI
-    conversation = f"{system_prompt}\n\nConversation history:\n"
-    for msg in recent_history:
-        role = "User" if msg['role'] == 'user' else "AI"
-        conversation += f"{role}: {msg['content']}\n"
-    
-    conversation += "\nRespond naturally in English (2-3 sentences). If the user made grammar or vocabulary mistakes, gently correct them at the end like: '✏️ Small correction: ...'"
+    payload = {
+        "model": DIALOG_MODEL,
+        "max_tokens": 300,
+        "system": build_dialog_system(system_prompt, context.user_data.get('dialog_summary')),
+        "messages": build_dialog_messages(history[start:])
+    }
     
+    # Перші слова надсилаються одразу, далі повідомлення редагується не частіше DIALOG_EDIT_INTERVAL
+    ai_response = ""
+    sent_message = None
+    last_edit = 0
+    stream = stream_dialog_reply(payload)
     try:
-        # Використовуємо простий запит до Claude API
-        import requests
-        
-        response = requests.post(
-            "https://api.anthropic.com/v1/messages",
-            headers={
-                "Content-Type": "application/json",
-                "x-api-key": os.getenv("ANTHROPIC_API_KEY", ""),
-                "anthropic-version": "2023-06-01"
-            },
-            json={
-                "model": "claude-sonnet-4-20250514",
-                "max_tokens": 300,
-                "messages": [
-                    {"role": "user", "content": conversation}
-                ]
-            },
-            timeout=30
-        )
+        while True:
+            # Поки нічого не надіслано, чекаємо не довше дедлайну
+            timeout = None if sent_message is not None or deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                chunk = await asyncio.wait_for(anext(stream), timeout)
+            except StopAsyncIteration:
+                break
+            
+            ai_response += chunk
+            if not ai_response.strip():
+                continue
+            
+            now = time.monotonic()
+            if sent_message is None:
+                sent_message = await update.message.reply_text(f"💬 **AI:** {ai_response} ▌")
+                last_edit = now
+            elif now - last_edit >= DIALOG_EDIT_INTERVAL:
+                await edit_dialog_message(sent_message, f"💬 **AI:** {ai_response} ▌")
+                last_edit = now
+    except asyncio.TimeoutError:
+        logger.warning(f"Dialog reply for user {user_id} missed its deadline")
+    except Exception as e:
+        logger.error(f"Dialog AI error: {e}")
+    finally:
+        await stream.aclose()
+    
+    if sent_message is None:
+        # Якщо API не працює - використовуємо простий fallback
+        await fallback_dialog_response(update, user_message, context)
+        return
+    
+    # Додаємо відповідь AI в історію
+    history.append({
+        'role': 'assistant',
+        'content': ai_response
+    })
+    
+    # Коли історія перевищує бюджет, старіші репліки згортаються у фоні,
+    # щоб префікс запиту (і кеш) залишався стабільним кілька ходів поспіль
+    if history_tokens(history) > DIALOG_HISTORY_TOKENS and not context.user_data.get('dialog_summarizing'):
+        count = trim_dialog_history(history, DIALOG_HISTORY_TOKENS // 2)
+        if count > 0:
+            context.user_data['dialog_summarizing'] = True
+            context.application.create_task(summarize_dialog(context.user_data, history, count))
+    
+    keyboard = [[InlineKeyboardButton("❌ Завершити діалог", callback_data="dialog_end")]]
+    
+    await edit_dialog_message(
+        sent_message,
+        f"💬 **AI:** {ai_response}",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+# Планувальник запитів діалогу
+DIALOG_MAX_CONCURRENCY = int(os.getenv("DIALOG_MAX_CONCURRENCY", "8"))
+DIALOG_DEADLINE = float(os.getenv("DIALOG_DEADLINE", "15"))
+
+class PendingDialog:
+    __slots__ = ('update', 'context', 'messages', 'enqueued_at')
+
+    def __init__(self, update, context, message):
+        self.update = update
+        self.context = context
+        self.messages = [message]
+        self.enqueued_at = time.monotonic()
+
+class DialogScheduler:
+    """Обмежує кількість одночасних запитів до AI і тримає один запит на користувача.
+
+    Повідомлення, що прийшли поки попередній запит користувача виконується,
+    склеюються в один наступний запит. Якщо до дедлайну відповідь не почалась,
+    користувач отримує запасну відповідь.
+    """
+
+    def __init__(self, max_concurrency, deadline):
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.deadline = deadline
+        self.pending = {}
+        self.active = set()
+        self.wait_times = deque(maxlen=1000)
+        self.stats = {'requests': 0, 'coalesced': 0, 'fallbacks': 0}
+
+    def submit(self, user_id, update, context, message):
+        pending = self.pending.get(user_id)
+        if pending is not None:
+            # Відповідаємо на останнє повідомлення, але з урахуванням усіх
+            pending.update = update
+            pending.context = context
+            pending.messages.append(message)
+            self.stats['coalesced'] += 1
+            return
         
-        if response.status_code == 200:
-            data = response.json()
-            ai_response = data['content'][0]['text']
-            
-            # Додаємо відповідь AI в історію
-            context.user_data['dialog_history'].append({
-                'role': 'assistant',
-                'content': ai_response
-            })
-            
-            keyboard = [[InlineKeyboardButton("❌ Завершити діалог", callback_data="dialog_end")]]
-            
-            await update.message.reply_text(
-                f"💬 **AI:** {ai_response}",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+        self.pending[user_id] = PendingDialog(update, context, message)
+        if user_id not in self.active:
+            self.active.add(user_id)
+            context.application.create_task(self._run(user_id))
+
+    async def _run(self, user_id):
+        try:
+            while user_id in self.pending:
+                deadline = self.pending[user_id].enqueued_at + self.deadline
+                try:
+                    await asyncio.wait_for(self.slots.acquire(), max(deadline - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    job = self.pending.pop(user_id)
+                    self.record(job, fallback=True)
+                    message = "\n".join(job.messages)
+                    job.context.user_data.setdefault('dialog_history', []).append({'role': 'user', 'content': message})
+                    await fallback_dialog_response(job.update, message, job.context)
+                    continue
+                
+                try:
+                    # Забираємо повідомлення лише зараз, щоб склеїти все, що прийшло під час очікування
+                    job = self.pending.pop(user_id)
+                    if get_state(job.context) != 'dialog':
+                        continue
+                    self.record(job)
+                    await process_dialog_message(job.update, job.context, "\n".join(job.messages), deadline)
+                except Exception as e:
+                    logger.error(f"Dialog scheduler error for user {user_id}: {e}")
+                finally:
+                    self.slots.release()
+        finally:
+            self.active.discard(user_id)
+
+    def record(self, job, fallback=False):
+        self.wait_times.append(time.monotonic() - job.enqueued_at)
+        self.stats['requests'] += 1
+        if fallback:
+            self.stats['fallbacks'] += 1
+        
+        if self.stats['requests'] % 100 == 0:
+            waits = sorted(self.wait_times)
+            p50 = waits[len(waits) // 2]
+            p95 = waits[int(len(waits) * 0.95)]
+            logger.info(
+                f"Dialog scheduler: {self.stats}, queue wait p50 {p50:.2f}s p95 {p95:.2f}s, "
+                f"{len(self.active)} users active"
             )
-        else:
-            # Якщо API не працює - використовуємо простий fallback
-            await fallback_dialog_response(update, user_message, context)
-            
-    except Exception as e:
-        logger.error(f"Dialog AI error: {e}")
-        # Fallback на випадок помилки
-        await fallback_dialog_response(update, user_message, context)
+
+dialog_scheduler = DialogScheduler(DIALOG_MAX_CONCURRENCY, DIALOG_DEADLINE)
 
 # Запасна відповідь якщо API не працює
 async def fallback_dialog_response(update: Update, user_message: str, context: ContextTypes.DEFAULT_TYPE):
@@ -463,8 +2023,7 @@ async def fallback_dialog_response(update: Update, user_message: str, context: C
 # Додавання свого слова
 async def add_custom_word_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Початок процесу додавання свого слова"""
-    context.user_data['adding_custom_word'] = True
-    context.user_data['custom_word_step'] = 'ukrainian'
+    enter_state(context, 'add_word', custom_word_step='ukrainian')
     
     await update.message.reply_text(
         "➕ **Додати своє слово**\n\n"
@@ -476,12 +2035,10 @@ async def add_custom_word_start(update: Update, context: ContextTypes.DEFAULT_TY
 async def process_custom_word(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
     """Обробка додавання свого слова"""
     user_id = str(update.effective_user.id)
-    data = init_user(user_id)
+    await unit_of_work(context, user_id).load()
     
     if text == "❌ Скасувати":
-        context.user_data['adding_custom_word'] = False
-        context.user_data['custom_word_step'] = None
-        context.user_data.pop('custom_word_ukrainian', None)
+        leave_state(context, 'add_word')
         await update.message.reply_text("❌ Скасовано", reply_markup=get_main_menu())
         return
     
@@ -504,29 +2061,20 @@ async def process_custom_word(update: Update, context: ContextTypes.DEFAULT_TYPE
         ukrainian_word = context.user_data.get('custom_word_ukrainian', '')
         english_word = text.strip()
         
-        # Перевіряємо чи слово вже є
-        if any(c['english'].lower() == english_word.lower() for c in data['cards']):
+        # Додаємо слово (унікальний індекс відкидає слова що вже є)
+        added = await add_cards_async(user_id, [Card(ukrainian_word, english_word)])
+        
+        if not added:
             await update.message.reply_text(
                 "⚠️ Це слово вже є у вашому словнику!\n\nСпробуйте інше слово:",
                 reply_markup=ReplyKeyboardMarkup([[KeyboardButton("❌ Скасувати")]], resize_keyboard=True)
             )
             return
         
-        # Додаємо слово
-        data['cards'].append({
-            'ukrainian': ukrainian_word,
-            'english': english_word,
-            'added_date': datetime.now().isoformat(),
-            'next_review': datetime.now().isoformat(),
-            'interval': 1
-        })
-        
-        save_user_data(user_id, data)
+        total, _ = await count_cards_async(user_id)
         
         # Скидаємо стан
-        context.user_data['adding_custom_word'] = False
-        context.user_data['custom_word_step'] = None
-        context.user_data.pop('custom_word_ukrainian', None)
+        leave_state(context, 'add_word')
         
         keyboard = [
             [InlineKeyboardButton("➕ Додати ще слово", callback_data="add_another_word")],
@@ -537,7 +2085,7 @@ async def process_custom_word(update: Update, context: ContextTypes.DEFAULT_TYPE
             f"✅ **Слово додано!**\n\n"
             f"🇺🇦 {ukrainian_word}\n"
             f"🇬🇧 {english_word}\n\n"
-            f"📊 Всього слів у словнику: {len(data['cards'])}",
+            f"📊 Всього слів у словнику: {total}",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
         
@@ -554,14 +2102,80 @@ def translate_word(text, from_lang='auto', to_lang='uk'):
         logger.error(f"Translation error: {e}")
         return None
 
+# Кеш перекладів: LRU у пам'яті + таблиця translations
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "20000"))
+TRANSLATION_CACHE_TTL = float(os.getenv("TRANSLATION_CACHE_TTL", str(30 * 24 * 3600)))
+
+class TranslationCache:
+    """Дворівневий кеш перекладів з лічильниками влучань"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0}
+
+    @staticmethod
+    def key(text, from_lang, to_lang):
+        # Регістр не нормалізується: "US" і "us", "Turkey" і "turkey" перекладаються по-різному
+        return (from_lang, to_lang, ' '.join(text.split()))
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        translation, stored_at = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return translation
+
+    def put(self, key, translation):
+        self.entries[key] = (translation, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def count(self, kind):
+        self.stats[kind] += 1
+        total = sum(self.stats.values())
+        if total % 1000 == 0:
+            hits = self.stats['memory_hits'] + self.stats['db_hits']
+            logger.info(f"Translation cache: {self.stats}, hit rate {hits / total:.1%}")
+
+translation_cache = TranslationCache(TRANSLATION_CACHE_SIZE, TRANSLATION_CACHE_TTL)
+
+async def translate_cached(text, from_lang='auto', to_lang='uk'):
+    """Переклад через кеш: пам'ять -> БД -> Google Translate"""
+    key = translation_cache.key(text, from_lang, to_lang)
+    
+    translation = translation_cache.get(key)
+    if translation is not None:
+        translation_cache.count('memory_hits')
+        return translation
+    
+    source_lang, target_lang, source_text = key
+    translation = await run_db(load_cached_translation, source_text, source_lang, target_lang, translation_cache.ttl)
+    if translation is not None:
+        translation_cache.count('db_hits')
+        translation_cache.put(key, translation)
+        return translation
+    
+    translation_cache.count('misses')
+    translation = await run_network(translate_word, text, from_lang, to_lang)
+    
+    # Невдалі переклади не кешуються
+    if translation:
+        translation_cache.put(key, translation)
+        await run_db(save_cached_translation, source_text, source_lang, target_lang, translation)
+    return translation
+
 # Reverso приклади (ПОКРАЩЕНА ВЕРСІЯ)
-def get_reverso_examples(word, source_lang='en', target_lang='uk'):
+async def get_reverso_examples(word, source_lang='en', target_lang='uk'):
     try:
-        import requests
-        from bs4 import BeautifulSoup
-        
         # Reverso Context URL
-        url = f"https://context.reverso.net/translation/{source_lang}-{target_lang}/{word}"
+        url = f"{REVERSO_BASE_URL}/translation/{source_lang}-{target_lang}/{word}"
         
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -570,13 +2184,24 @@ def get_reverso_examples(word, source_lang='en', target_lang='uk'):
             'Referer': 'https://context.reverso.net/'
         }
         
-        response = requests.get(url, headers=headers, timeout=10)
+        response = await http_client.get(url, headers=headers)
         
         if response.status_code != 200:
             logger.warning(f"Reverso returned status {response.status_code}")
             return []
         
-        soup = BeautifulSoup(response.content, 'html.parser')
+        # Розбір HTML займає помітний час, тому виконується поза event loop
+        return await run_network(parse_reverso_examples, response.content, word)
+    
+    except Exception as e:
+        logger.error(f"Reverso error: {e}")
+        return []
+
+def parse_reverso_examples(content, word):
+    try:
+        from bs4 import BeautifulSoup
+        
+        soup = BeautifulSoup(content, 'html.parser')
         examples = []
         
         # Шукаємо приклади (Reverso може мати різну структуру)
@@ -613,7 +2238,7 @@ def get_reverso_examples(word, source_lang='en', target_lang='uk'):
         return examples
     
     except Exception as e:
-        logger.error(f"Reverso error: {e}")
+        logger.error(f"Reverso parse error: {e}")
         return []
 
 def get_flag(lang_code):
@@ -623,7 +2248,7 @@ def get_flag(lang_code):
 # Команда /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    init_user(user_id)
+    await unit_of_work(context, user_id).load()
     
     await update.message.reply_text("""
 🎓 **Вітаю у Language Learning Bot!**
@@ -669,12 +2294,13 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Налаштування
 async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = init_user(user_id)
+    data = await unit_of_work(context, user_id).load()
     
     keyboard = [
         [InlineKeyboardButton(f"🎯 Рівень: {data['level']}", callback_data="settings_level")],
         [InlineKeyboardButton("🌍 Мова", callback_data="settings_language")],
-        [InlineKeyboardButton("⏰ Нагадування", callback_data="settings_reminders")]
+        [InlineKeyboardButton("⏰ Нагадування", callback_data="settings_reminders")],
+        [InlineKeyboardButton(f"🧠 Алгоритм: {get_scheduler(data).title}", callback_data="settings_scheduler")]
     ]
     
     await update.message.reply_text("⚙️ **Налаштування:**", reply_markup=InlineKeyboardMarkup(keyboard))
@@ -682,7 +2308,7 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Текст
 async def text_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = init_user(user_id)
+    data = await unit_of_work(context, user_id).load()
     
     level = data['level']
     texts = TEXTS_DATABASE.get(level, TEXTS_DATABASE['B1'])
@@ -696,75 +2322,132 @@ async def text_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Переклад
 async def translate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Введіть слово:", reply_markup=get_main_menu())
-    context.user_data['waiting_for_translation'] = True
+    enter_state(context, 'translate')
+
+# Бюджет очікування прикладів: скільки чекати перед першою відповіддю і загалом
+EXAMPLES_INLINE_WAIT = float(os.getenv("EXAMPLES_INLINE_WAIT", "0.3"))
+EXAMPLES_TIMEOUT = float(os.getenv("EXAMPLES_TIMEOUT", "6"))
+
+# Базові приклади для поширених слів
+BASIC_EXAMPLES = {
+    'book': [
+        {'source': 'I read this book last week', 'target': 'Я читав цю книгу минулого тижня'},
+        {'source': 'She loves reading books', 'target': 'Вона любить читати книги'}
+    ],
+    'hello': [
+        {'source': 'Hello, how are you?', 'target': 'Привіт, як справи?'},
+        {'source': 'He said hello to everyone', 'target': 'Він привітав усіх'}
+    ],
+    'work': [
+        {'source': 'I work from home', 'target': 'Я працюю з дому'},
+        {'source': 'She works hard every day', 'target': 'Вона важко працює щодня'}
+    ],
+    'learn': [
+        {'source': 'I want to learn English', 'target': 'Я хочу вивчити англійську'},
+        {'source': 'Learning languages is fun', 'target': 'Вивчення мов це весело'}
+    ],
+    'love': [
+        {'source': 'I love my family', 'target': 'Я люблю свою сім\'ю'},
+        {'source': 'She loves traveling', 'target': 'Вона любить подорожувати'}
+    ]
+}
+
+# Кеш прикладів: знайдені живуть довго, порожні і невдалі запити - недовго
+EXAMPLES_CACHE_TTL = float(os.getenv("EXAMPLES_CACHE_TTL", str(30 * 24 * 3600)))
+EXAMPLES_NEGATIVE_TTL = float(os.getenv("EXAMPLES_NEGATIVE_TTL", str(6 * 3600)))
+
+async def fetch_examples(word, source_lang='en', target_lang='uk'):
+    """Приклади з кешу або Reverso, а якщо їх немає - базові"""
+    key = word.lower()
+    
+    cached = await run_db(load_cached_examples, key, source_lang, target_lang)
+    if cached is not None:
+        examples, created_at = cached
+        ttl = EXAMPLES_CACHE_TTL if examples else EXAMPLES_NEGATIVE_TTL
+        if datetime.now() - created_at < timedelta(seconds=ttl):
+            return examples or BASIC_EXAMPLES.get(key, [])
+    
+    examples = await get_reverso_examples(word, source_lang, target_lang)
+    await run_db(save_cached_examples, key, source_lang, target_lang, examples)
+    return examples or BASIC_EXAMPLES.get(key, [])
+
+def format_examples(examples):
+    text = "\n\n📝 **Приклади:**"
+    for i, ex in enumerate(examples[:3], 1):
+        text += f"\n{i}. {ex['source']}"
+        text += f"\n   → {ex['target']}\n"
+    return text
+
+# Запити прикладів, що не вклались у бюджет, але мають дійти до кешу
+late_examples_tasks = set()
+
+async def add_examples_later(sent_message, response, reply_markup, examples_task, word, started):
+    """Дописує приклади в уже надіслане повідомлення, коли вони прийдуть"""
+    try:
+        remaining = max(EXAMPLES_TIMEOUT - (time.monotonic() - started), 0)
+        # shield: бюджет обмежує лише очікування, сам запит і запис у кеш (зокрема негативний) завершуються
+        examples = await asyncio.wait_for(asyncio.shield(examples_task), remaining)
+    except asyncio.TimeoutError:
+        logger.warning(f"Examples for '{word}' exceeded the {EXAMPLES_TIMEOUT}s budget")
+        late_examples_tasks.add(examples_task)
+        examples_task.add_done_callback(late_examples_tasks.discard)
+        examples = BASIC_EXAMPLES.get(word.lower(), [])
+    
+    if examples:
+        try:
+            await sent_message.edit_text(response + format_examples(examples), reply_markup=reply_markup)
+        except Exception as e:
+            logger.error(f"Error adding examples: {e}")
 
 async def process_translation(update, word, context, message=None):
     user_id = str(update.effective_user.id if not message else update.message.from_user.id)
-    data = init_user(user_id)
+    data = await unit_of_work(context, user_id).load()
     
     target_lang = data['target_language']
     is_cyrillic = any('\u0400' <= char <= '\u04FF' for char in word)
     
+    # Приклади для англійських окремих слів шукаємо паралельно з перекладом
+    examples_task = None
+    started = time.monotonic()
+    if len(word.split()) == 1 and not is_cyrillic and target_lang == 'en':
+        examples_task = asyncio.create_task(fetch_examples(word))
+    
     if is_cyrillic:
-        translation = translate_word(word, from_lang='uk', to_lang=target_lang)
+        translation = await translate_cached(word, from_lang='uk', to_lang=target_lang)
         from_word, to_word = word, translation
         from_flag, to_flag = "🇺🇦", get_flag(target_lang)
-        reverso_lang = 'uk'
     else:
-        translation = translate_word(word, from_lang=target_lang, to_lang='uk')
+        translation = await translate_cached(word, from_lang=target_lang, to_lang='uk')
         from_word, to_word = word, translation
         from_flag, to_flag = get_flag(target_lang), "🇺🇦"
-        reverso_lang = target_lang
     
     if translation:
         response = f"{from_flag} **{from_word}**\n{to_flag} **{to_word}**"
         
-        # Додаємо приклади для англійських окремих слів
-        if len(from_word.split()) == 1 and not is_cyrillic and target_lang == 'en':
-            examples = get_reverso_examples(from_word, source_lang='en', target_lang='uk')
-            
-            # Якщо Reverso не дав прикладів - використовуємо базові
-            if not examples or len(examples) == 0:
-                # Базові приклади для поширених слів
-                basic_examples = {
-                    'book': [
-                        {'source': 'I read this book last week', 'target': 'Я читав цю книгу минулого тижня'},
-                        {'source': 'She loves reading books', 'target': 'Вона любить читати книги'}
-                    ],
-                    'hello': [
-                        {'source': 'Hello, how are you?', 'target': 'Привіт, як справи?'},
-                        {'source': 'He said hello to everyone', 'target': 'Він привітав усіх'}
-                    ],
-                    'work': [
-                        {'source': 'I work from home', 'target': 'Я працюю з дому'},
-                        {'source': 'She works hard every day', 'target': 'Вона важко працює щодня'}
-                    ],
-                    'learn': [
-                        {'source': 'I want to learn English', 'target': 'Я хочу вивчити англійську'},
-                        {'source': 'Learning languages is fun', 'target': 'Вивчення мов це весело'}
-                    ],
-                    'love': [
-                        {'source': 'I love my family', 'target': 'Я люблю свою сім\'ю'},
-                        {'source': 'She loves traveling', 'target': 'Вона любить подорожувати'}
-                    ]
-                }
-                
-                examples = basic_examples.get(from_word.lower(), [])
-            
-            if examples and len(examples) > 0:
-                response += "\n\n📝 **Приклади:**"
-                for i, ex in enumerate(examples[:3], 1):
-                    response += f"\n{i}. {ex['source']}"
-                    response += f"\n   → {ex['target']}\n"
-        
         keyboard = [[InlineKeyboardButton("➕ Додати в словник", callback_data=f"add_to_cards:{from_word}:{to_word}")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        if message:
-            await message.reply_text(response, reply_markup=reply_markup)
-        else:
-            await update.callback_query.message.reply_text(response, reply_markup=reply_markup)
+        # Якщо приклади вже готові - відправляємо все одразу
+        text = response
+        if examples_task:
+            await asyncio.wait({examples_task}, timeout=EXAMPLES_INLINE_WAIT)
+            if examples_task.done() and not examples_task.cancelled() and examples_task.exception() is None:
+                examples = examples_task.result()
+                if examples:
+                    text += format_examples(examples)
+        
+        target_message = message or update.callback_query.message
+        sent_message = await target_message.reply_text(text, reply_markup=reply_markup)
+        
+        # Інакше дописуємо їх пізніше, не затримуючи відповідь
+        if examples_task and not examples_task.done():
+            context.application.create_task(
+                add_examples_later(sent_message, response, reply_markup, examples_task, from_word, started)
+            )
     else:
+        if examples_task:
+            examples_task.cancel()
+        
         error_msg = f"❌ Не вдалося перекласти '{word}'"
         if message:
             await message.reply_text(error_msg, reply_markup=get_main_menu())
@@ -774,7 +2457,7 @@ async def process_translation(update, word, context, message=None):
 # Словник
 async def dictionary_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = init_user(user_id)
+    total, _ = await count_cards_async(user_id)
     
     keyboard = [
         [InlineKeyboardButton("📋 Мої слова", callback_data="dict_my")],
@@ -783,7 +2466,7 @@ async def dictionary_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     ]
     
     await update.message.reply_text(
-        f"📕 **Словник**\n\nВаших слів: {len(data['cards'])}",
+        f"📕 **Словник**\n\nВаших слів: {total}",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
@@ -798,9 +2481,9 @@ async def games_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Гра вгадування
 async def game_guess_command(update: Update, context: ContextTypes.DEFAULT_TYPE, from_callback=False):
     user_id = str(update.effective_user.id if not from_callback else update.callback_query.from_user.id)
-    data = init_user(user_id)
+    options = await sample_cards_async(user_id, 4)
     
-    if len(data['cards']) < 4:
+    if len(options) < 4:
         msg = "Потрібно мінімум 4 слова!"
         if from_callback:
             await update.callback_query.message.reply_text(msg)
@@ -808,16 +2491,13 @@ async def game_guess_command(update: Update, context: ContextTypes.DEFAULT_TYPE,
             await update.message.reply_text(msg)
         return
     
-    correct = random.choice(data['cards'])
-    wrong = random.sample([c for c in data['cards'] if c != correct], 3)
-    options = [correct] + wrong
-    random.shuffle(options)
+    correct = random.choice(options)
     
-    context.user_data['game_correct'] = correct['english']
+    enter_state(context, 'guess', game_correct=correct.english)
     
-    keyboard = [[InlineKeyboardButton(opt['english'], callback_data=f"game_answer:{opt['english']}")] for opt in options]
+    keyboard = [[InlineKeyboardButton(opt.english, callback_data=f"game_answer:{opt.english}")] for opt in options]
     
-    msg = f"🎮 **Вгадай**\n\n🇺🇦 {correct['ukrainian']}"
+    msg = f"🎮 **Вгадай**\n\n🇺🇦 {correct.ukrainian}"
     
     if from_callback:
         await update.callback_query.message.reply_text(msg, reply_markup=InlineKeyboardMarkup(keyboard))
@@ -827,19 +2507,18 @@ async def game_guess_command(update: Update, context: ContextTypes.DEFAULT_TYPE,
 # Гра скремблер
 async def game_scramble_command(update: Update, context: ContextTypes.DEFAULT_TYPE, from_callback=False):
     user_id = str(update.effective_user.id if not from_callback else update.callback_query.from_user.id)
-    data = init_user(user_id)
+    cards = await sample_cards_async(user_id, 1)
     
-    if not data['cards']:
+    if not cards:
         return
     
-    card = random.choice(data['cards'])
-    word = card['english']
+    card = cards[0]
+    word = card.english
     scrambled = ''.join(random.sample(word, len(word)))
     
-    context.user_data['scramble_word'] = word.lower()
-    context.user_data['scramble_translation'] = card['ukrainian']
+    enter_state(context, 'scramble', scramble_word=word.lower(), scramble_translation=card.ukrainian)
     
-    msg = f"🔤 **Скремблер**\n\nСкладіть слово: **{scrambled.upper()}**\n\n💡 Підказка: {card['ukrainian']}"
+    msg = f"🔤 **Скремблер**\n\nСкладіть слово: **{scrambled.upper()}**\n\n💡 Підказка: {card.ukrainian}"
     
     if from_callback:
         await update.callback_query.message.reply_text(msg)
@@ -849,13 +2528,15 @@ async def game_scramble_command(update: Update, context: ContextTypes.DEFAULT_TY
 # Статистика
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = init_user(user_id)
+    await review_batcher.flush(user_id)
+    data = await unit_of_work(context, user_id).load()
+    total, _ = await count_cards_async(user_id)
     
     await update.message.reply_text(f"""
 📊 **Статистика**
 
 🎯 Рівень: {data['level']}
-📕 Слів: {len(data['cards'])}
+📕 Слів: {total}
 ✅ Повторень: {data['stats']['total_reviews']}
 🎮 Ігор: {data['game_stats']['total']}
     """, reply_markup=get_main_menu())
@@ -863,25 +2544,22 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Повторення
 async def review(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = init_user(user_id)
+    total, due_count = await count_cards_async(user_id)
     
-    if not data['cards']:
+    if not total:
         await update.message.reply_text("Немає слів!", reply_markup=get_main_menu())
         return
     
-    now = datetime.now()
-    due = [i for i, c in enumerate(data['cards']) if datetime.fromisoformat(c['next_review']) <= now]
-    
     # Вибір: повторити по розкладу або всі слова
     keyboard = [
-        [InlineKeyboardButton(f"📅 По розкладу ({len(due)} слів)", callback_data="review_scheduled")],
-        [InlineKeyboardButton(f"📚 Всі слова ({len(data['cards'])} слів)", callback_data="review_all")]
+        [InlineKeyboardButton(f"📅 По розкладу ({due_count} слів)", callback_data="review_scheduled")],
+        [InlineKeyboardButton(f"📚 Всі слова ({total} слів)", callback_data="review_all")]
     ]
     
-    if len(due) == 0:
+    if due_count == 0:
         message_text = "🎉 **Повторення**\n\nСлів за розкладом: 0\n\nВиберіть режим:"
     else:
-        message_text = f"📚 **Повторення**\n\nСлів за розкладом: {len(due)}\nВсього слів: {len(data['cards'])}\n\nВиберіть режим:"
+        message_text = f"📚 **Повторення**\n\nСлів за розкладом: {due_count}\nВсього слів: {total}\n\nВиберіть режим:"
     
     await update.message.reply_text(
         message_text,
@@ -913,45 +2591,56 @@ async def show_review_mode_selection(query, due_count, review_type, context):
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+def review_scheduler(context):
+    """Алгоритм, обраний на початку сесії - відповіді не перечитують документ користувача"""
+    return SCHEDULERS[context.user_data['review_scheduler']]
+
+def next_review_hint(cards, now=None):
+    """Коли з'явиться перше слово сесії за новим розкладом"""
+    upcoming = min((card.next_review for card in cards), default=None)
+    if upcoming is None:
+        return ""
+    days = round((upcoming - (now or time.time())) / DAY)
+    if days <= 0:
+        return "💡 Деякі слова варто повторити ще сьогодні"
+    if days == 1:
+        return "💡 Наступне повторення - завтра"
+    return f"💡 Наступне повторення - через {days} дн."
+
+# Картки для сесії повторення: за розкладом або всі
+async def load_review_cards(user_id, review_type):
+    # Незаписані відповіді попередньої сесії мають потрапити в БД до вибірки
+    await review_batcher.flush(user_id)
+    if review_type == 'scheduled':
+        return await load_due_cards_async(user_id)
+    return await load_cards_async(user_id)
+
 # Класичний режим повторення
 async def start_classic_review(update, context, user_id, review_type='scheduled'):
     """Запускає класичне повторення з показом картки"""
-    data = init_user(user_id)
-    
-    now = datetime.now()
-    if review_type == 'scheduled':
-        due = [i for i, c in enumerate(data['cards']) if datetime.fromisoformat(c['next_review']) <= now]
-    else:  # all
-        due = list(range(len(data['cards'])))
+    due = await load_review_cards(user_id, review_type)
     
     if not due:
         await update.callback_query.edit_message_text("🎉 Немає слів для повторення!")
         return
     
-    context.user_data['reviewing'] = True
-    context.user_data['review_mode'] = 'classic'
-    context.user_data['current_card_index'] = due[0]
-    context.user_data['due_cards'] = due
+    scheduler = get_scheduler(await unit_of_work(context, user_id).load())
+    enter_state(context, 'review_classic', current_card_index=0, due_cards=due, review_scheduler=scheduler.name)
     
-    card = data['cards'][due[0]]
+    card = due[0]
     
     await update.callback_query.edit_message_text(
-        f"📚 Картка 1/{len(due)}\n\n🇺🇦 **{card['ukrainian']}**",
+        f"📚 Картка 1/{len(due)}\n\n🇺🇦 **{card.ukrainian}**",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Показати", callback_data="show_answer")]])
     )
 
 # Режим вікторини (1 з 4)
 async def start_quiz_review(update, context, user_id, review_type='scheduled'):
     """Запускає повторення в режимі вікторини з 4 варіантами"""
-    data = init_user(user_id)
-    
-    now = datetime.now()
-    if review_type == 'scheduled':
-        due = [i for i, c in enumerate(data['cards']) if datetime.fromisoformat(c['next_review']) <= now]
-    else:  # all
-        due = list(range(len(data['cards'])))
+    due = await load_review_cards(user_id, review_type)
     
-    if len(data['cards']) < 4:
+    total, _ = await count_cards_async(user_id)
+    if total < 4:
         await update.callback_query.edit_message_text(
             "❌ Для режиму вікторини потрібно мінімум 4 слова в словнику!",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="back_to_review")]])
@@ -962,35 +2651,25 @@ async def start_quiz_review(update, context, user_id, review_type='scheduled'):
         await update.callback_query.edit_message_text("🎉 Немає слів для повторення!")
         return
     
-    context.user_data['reviewing'] = True
-    context.user_data['review_mode'] = 'quiz'
-    context.user_data['current_card_index'] = due[0]
-    context.user_data['due_cards'] = due
+    scheduler = get_scheduler(await unit_of_work(context, user_id).load())
+    enter_state(context, 'review_quiz', current_card_index=0, due_cards=due, review_scheduler=scheduler.name)
     context.user_data['quiz_correct_count'] = 0
     
-    await show_quiz_card(update.callback_query, context, data, due, 0)
+    await show_quiz_card(update.callback_query, context, user_id, due, 0)
 
 # Швидкий режим - просто перегляд
 async def start_fast_review(update, context, user_id, review_type='scheduled'):
     """Швидкий режим - автоматичний показ слів"""
-    data = init_user(user_id)
-    
-    now = datetime.now()
-    if review_type == 'scheduled':
-        due = [i for i, c in enumerate(data['cards']) if datetime.fromisoformat(c['next_review']) <= now]
-    else:  # all
-        due = list(range(len(data['cards'])))
+    due = await load_review_cards(user_id, review_type)
     
     if not due:
         await update.callback_query.edit_message_text("🎉 Немає слів для повторення!")
         return
     
-    context.user_data['reviewing'] = True
-    context.user_data['review_mode'] = 'fast'
-    context.user_data['current_card_index'] = due[0]
-    context.user_data['due_cards'] = due
+    # Швидкий режим не оцінює картки, тож алгоритм повторення йому не потрібен
+    enter_state(context, 'review_fast', current_card_index=0, due_cards=due)
     
-    card = data['cards'][due[0]]
+    card = due[0]
     
     keyboard = [
         [InlineKeyboardButton("➡️ Далі", callback_data="fast_next")],
@@ -999,39 +2678,31 @@ async def start_fast_review(update, context, user_id, review_type='scheduled'):
     
     await update.callback_query.edit_message_text(
         f"⚡ **Швидкий режим** - {1}/{len(due)}\n\n"
-        f"🇺🇦 **{card['ukrainian']}**\n"
-        f"🇬🇧 **{card['english']}**",
+        f"🇺🇦 **{card.ukrainian}**\n"
+        f"🇬🇧 **{card.english}**",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
 # Режим написання
 async def start_typing_review(update, context, user_id, review_type='scheduled'):
     """Режим з введенням відповіді"""
-    data = init_user(user_id)
-    
-    now = datetime.now()
-    if review_type == 'scheduled':
-        due = [i for i, c in enumerate(data['cards']) if datetime.fromisoformat(c['next_review']) <= now]
-    else:  # all
-        due = list(range(len(data['cards'])))
+    due = await load_review_cards(user_id, review_type)
     
     if not due:
         await update.callback_query.edit_message_text("🎉 Немає слів для повторення!")
         return
     
-    context.user_data['reviewing'] = True
-    context.user_data['review_mode'] = 'typing'
-    context.user_data['current_card_index'] = due[0]
-    context.user_data['due_cards'] = due
+    scheduler = get_scheduler(await unit_of_work(context, user_id).load())
+    enter_state(context, 'review_typing', current_card_index=0, due_cards=due, review_scheduler=scheduler.name)
     context.user_data['typing_correct_count'] = 0
     
-    card = data['cards'][due[0]]
+    card = due[0]
     
     keyboard = [[InlineKeyboardButton("Пропустити", callback_data="typing_skip")]]
     
     await update.callback_query.edit_message_text(
         f"✍️ **Режим написання** - {1}/{len(due)}\n\n"
-        f"🇺🇦 **{card['ukrainian']}**\n\n"
+        f"🇺🇦 **{card.ukrainian}**\n\n"
         f"💡 Напишіть переклад англійською:",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
@@ -1039,15 +2710,10 @@ async def start_typing_review(update, context, user_id, review_type='scheduled')
 # Реверс режим (UA → EN)
 async def start_reverse_review(update, context, user_id, review_type='scheduled'):
     """Реверс режим - з української на англійську"""
-    data = init_user(user_id)
+    due = await load_review_cards(user_id, review_type)
     
-    now = datetime.now()
-    if review_type == 'scheduled':
-        due = [i for i, c in enumerate(data['cards']) if datetime.fromisoformat(c['next_review']) <= now]
-    else:  # all
-        due = list(range(len(data['cards'])))
-    
-    if len(data['cards']) < 4:
+    total, _ = await count_cards_async(user_id)
+    if total < 4:
         await update.callback_query.edit_message_text(
             "❌ Для цього режиму потрібно мінімум 4 слова!",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="back_to_review")]])
@@ -1058,813 +2724,1130 @@ async def start_reverse_review(update, context, user_id, review_type='scheduled'
         await update.callback_query.edit_message_text("🎉 Немає слів для повторення!")
         return
     
-    context.user_data['reviewing'] = True
-    context.user_data['review_mode'] = 'reverse'
-    context.user_data['current_card_index'] = due[0]
-    context.user_data['due_cards'] = due
+    scheduler = get_scheduler(await unit_of_work(context, user_id).load())
+    enter_state(context, 'review_reverse', current_card_index=0, due_cards=due, review_scheduler=scheduler.name)
     context.user_data['reverse_correct_count'] = 0
     
-    await show_reverse_card(update.callback_query, context, data, due, 0)
+    await show_reverse_card(update.callback_query, context, user_id, due, 0)
 
-async def show_reverse_card(query, context, data, due, position):
+async def show_reverse_card(query, context, user_id, due, position):
     """Показує картку в реверс режимі (Ukrainian → English)"""
-    idx = due[position]
-    correct_card = data['cards'][idx]
+    correct_card = due[position]
     
     # Вибираємо 3 неправильні відповіді
-    wrong_cards = [c for i, c in enumerate(data['cards']) if i != idx]
-    if len(wrong_cards) >= 3:
-        wrong_options = random.sample(wrong_cards, 3)
-    else:
-        wrong_options = wrong_cards
+    wrong_options = await sample_cards_async(user_id, 3, exclude_id=correct_card.id)
     
     # Формуємо всі варіанти (Ukrainian words)
     all_options = [correct_card] + wrong_options
     random.shuffle(all_options)
     
     # Зберігаємо правильну відповідь
-    context.user_data['reverse_correct_answer'] = correct_card['ukrainian']
+    context.user_data['reverse_correct_answer'] = correct_card.ukrainian
     
     # Створюємо кнопки з українськими словами
     keyboard = []
     for opt in all_options:
         keyboard.append([InlineKeyboardButton(
-            opt['ukrainian'], 
-            callback_data=f"reverse_answer:{opt['ukrainian']}"
+            opt.ukrainian, 
+            callback_data=f"reverse_answer:{opt.ukrainian}"
         )])
     
     await query.edit_message_text(
         f"🔄 **Реверс режим** - Картка {position + 1}/{len(due)}\n\n"
-        f"🇬🇧 **{correct_card['english']}**\n\n"
+        f"🇬🇧 **{correct_card.english}**\n\n"
         f"Виберіть правильний переклад українською:",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
-async def show_quiz_card(query, context, data, due, position):
+async def show_quiz_card(query, context, user_id, due, position):
     """Показує картку в режимі вікторини"""
-    idx = due[position]
-    correct_card = data['cards'][idx]
+    correct_card = due[position]
     
-    # Вибираємо 3 неправильні відповіді
-    wrong_cards = [c for i, c in enumerate(data['cards']) if i != idx]
-    if len(wrong_cards) >= 3:
-        wrong_options = random.sample(wrong_cards, 3)
-    else:
-        # Якщо менше 3 інших карток, додаємо ті що є
-        wrong_options = wrong_cards
+    # Вибираємо 3 неправильні відповіді (якщо інших карток менше - беремо ті що є)
+    wrong_options = await sample_cards_async(user_id, 3, exclude_id=correct_card.id)
     
     # Формуємо всі варіанти
     all_options = [correct_card] + wrong_options
     random.shuffle(all_options)
     
     # Зберігаємо правильну відповідь
-    context.user_data['quiz_correct_answer'] = correct_card['english']
+    context.user_data['quiz_correct_answer'] = correct_card.english
     
     # Створюємо кнопки
     keyboard = []
     for opt in all_options:
         keyboard.append([InlineKeyboardButton(
-            opt['english'], 
-            callback_data=f"quiz_answer:{opt['english']}"
+            opt.english, 
+            callback_data=f"quiz_answer:{opt.english}"
         )])
     
     await query.edit_message_text(
         f"🎯 **Вікторина** - Картка {position + 1}/{len(due)}\n\n"
-        f"🇺🇦 **{correct_card['ukrainian']}**\n\n"
+        f"🇺🇦 **{correct_card.ukrainian}**\n\n"
         f"Виберіть правильний переклад:",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
-# Обробка повідомлень
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Режим написання - перевірка введеної відповіді
+async def process_typing_answer(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
     user_id = str(update.effective_user.id)
-    text = update.message.text
-    
-    # Меню
-    if text == "📖 Текст":
-        await text_command(update, context)
-    elif text == "🔄 Перекласти":
-        await translate_command(update, context)
-    elif text == "➕ Додати слово":
-        await add_custom_word_start(update, context)
-    elif text == "📚 Повторити":
-        await review(update, context)
-    elif text == "📕 Словник":
-        await dictionary_command(update, context)
-    elif text == "🎮 Ігри":
-        await games_menu(update, context)
-    elif text == "💬 Діалог AI":
-        await dialog_menu(update, context)
-    elif text == "🎓 Курси":
-        await courses_menu(update, context)
-    elif text == "📊 Статистика":
-        await stats(update, context)
-    elif text == "⚙️ Налаштування":
-        await settings_command(update, context)
-    elif text == "❓ Допомога":
-        await help_command(update, context)
-    # Додавання свого слова
-    elif context.user_data.get('adding_custom_word'):
-        await process_custom_word(update, context, text)
-        return
-    # Режим написання - перевірка введеної відповіді
-    elif context.user_data.get('review_mode') == 'typing':
-        user_id = str(update.effective_user.id)
-        data = init_user(user_id)
-        
-        idx = context.user_data.get('current_card_index')
-        card = data['cards'][idx]
-        due = context.user_data.get('due_cards', [])
-        current_pos = due.index(idx)
-        
-        # Перевіряємо відповідь (з урахуванням регістру)
-        user_answer = text.strip().lower()
-        correct_answer = card['english'].lower()
-        
-        if user_answer == correct_answer:
-            # Правильно
-            context.user_data['typing_correct_count'] = context.user_data.get('typing_correct_count', 0) + 1
-            data['cards'][idx]['next_review'] = (datetime.now() + timedelta(days=2)).isoformat()
-            data['stats']['total_reviews'] += 1
-            data['stats']['correct'] += 1
-            save_user_data(user_id, data)
-            
-            await update.message.reply_text("✅ Правильно!")
-        else:
-            # Неправильно
-            data['cards'][idx]['next_review'] = (datetime.now() + timedelta(days=1)).isoformat()
-            data['stats']['total_reviews'] += 1
-            save_user_data(user_id, data)
-            
-            await update.message.reply_text(f"❌ Неправильно!\nПравильно: **{card['english']}**")
-        
-        # Наступна картка або завершення
-        if current_pos + 1 < len(due):
-            next_idx = due[current_pos + 1]
-            context.user_data['current_card_index'] = next_idx
-            next_card = data['cards'][next_idx]
-            
-            keyboard = [[InlineKeyboardButton("Пропустити", callback_data="typing_skip")]]
-            
-            await update.message.reply_text(
-                f"✍️ **Режим написання** - {current_pos + 2}/{len(due)}\n\n"
-                f"🇺🇦 **{next_card['ukrainian']}**\n\n"
-                f"💡 Напишіть переклад англійською:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        else:
-            # Завершення
-            correct_count = context.user_data.get('typing_correct_count', 0)
-            total = len(due)
-            percentage = int((correct_count / total) * 100) if total > 0 else 0
-            
-            context.user_data.clear()
-            
+
+    due = context.user_data.get('due_cards', [])
+    current_pos = context.user_data.get('current_card_index')
+    card = due[current_pos]
+
+    scheduler = review_scheduler(context)
+
+    # Перевіряємо відповідь (з урахуванням регістру)
+    user_answer = text.strip().lower()
+    correct_answer = card.english.lower()
+
+    if user_answer == correct_answer:
+        # Правильно
+        context.user_data['typing_correct_count'] = context.user_data.get('typing_correct_count', 0) + 1
+        await review_batcher.record(user_id, card, GOOD, scheduler, {('stats', 'total_reviews'): 1, ('stats', 'correct'): 1})
+
+        await update.message.reply_text("✅ Правильно!")
+    else:
+        # Неправильно
+        await review_batcher.record(user_id, card, AGAIN, scheduler, {('stats', 'total_reviews'): 1})
+
+        await update.message.reply_text(f"❌ Неправильно!\nПравильно: **{card.english}**")
+
+    # Наступна картка або завершення
+    if current_pos + 1 < len(due):
+        context.user_data['current_card_index'] = current_pos + 1
+        next_card = due[current_pos + 1]
+
+        keyboard = [[InlineKeyboardButton("Пропустити", callback_data="typing_skip")]]
+
+        await update.message.reply_text(
+            f"✍️ **Режим написання** - {current_pos + 2}/{len(due)}\n\n"
+            f"🇺🇦 **{next_card.ukrainian}**\n\n"
+            f"💡 Напишіть переклад англійською:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    else:
+        # Завершення
+        correct_count = context.user_data.get('typing_correct_count', 0)
+        total = len(due)
+        percentage = int((correct_count / total) * 100) if total > 0 else 0
+
+        leave_state(context, 'review_typing')
+        await review_batcher.flush(user_id)
+
+        await update.message.reply_text(
+            f"✅ **Режим написання завершено!**\n\n"
+            f"📊 Результат: {correct_count}/{total} ({percentage}%)\n\n"
+            f"{next_review_hint(due)}",
+            reply_markup=get_main_menu()
+        )
+
+# Видалення зі словника
+async def process_dict_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    user_id = str(update.effective_user.id)
+    cards = await load_cards_async(user_id)
+    deleted = False
+
+    # Перевірка чи це номер
+    try:
+        num = int(text) - 1
+        if 0 <= num < len(cards):
+            deleted_card = cards[num]
+            await delete_card_async(user_id, deleted_card.id)
+            deleted = True
             await update.message.reply_text(
-                f"✅ **Режим написання завершено!**\n\n"
-                f"📊 Результат: {correct_count}/{total} ({percentage}%)\n\n"
-                f"💡 Слова з'являться через 1-2 дні",
+                f"🗑 Видалено: {deleted_card.ukrainian} → {deleted_card.english}",
                 reply_markup=get_main_menu()
             )
-        return
-    # Активний діалог з AI
-    elif context.user_data.get('dialog_active'):
-        await process_dialog_message(update, context, text)
-        return
-    # Видалення зі словника
-    elif context.user_data.get('dict_delete_mode'):
-        data = init_user(user_id)
-        deleted = False
-        
-        # Перевірка чи це номер
-        try:
-            num = int(text) - 1
-            if 0 <= num < len(data['cards']):
-                deleted_card = data['cards'].pop(num)
-                save_user_data(user_id, data)
+    except ValueError:
+        # Це не номер, шукаємо по назві
+        for card in cards:
+            if text.lower() in card.ukrainian.lower() or text.lower() in card.english.lower():
+                deleted_card = card
+                await delete_card_async(user_id, card.id)
                 deleted = True
                 await update.message.reply_text(
-                    f"🗑 Видалено: {deleted_card['ukrainian']} → {deleted_card['english']}",
+                    f"🗑 Видалено: {deleted_card.ukrainian} → {deleted_card.english}",
                     reply_markup=get_main_menu()
                 )
-        except ValueError:
-            # Це не номер, шукаємо по назві
-            for i, card in enumerate(data['cards']):
-                if text.lower() in card['ukrainian'].lower() or text.lower() in card['english'].lower():
-                    deleted_card = data['cards'].pop(i)
-                    save_user_data(user_id, data)
-                    deleted = True
-                    await update.message.reply_text(
-                        f"🗑 Видалено: {deleted_card['ukrainian']} → {deleted_card['english']}",
-                        reply_markup=get_main_menu()
-                    )
-                    break
-        
-        if not deleted:
-            await update.message.reply_text("❌ Слово не знайдено", reply_markup=get_main_menu())
-        
-        context.user_data['dict_delete_mode'] = False
+                break
+
+    if not deleted:
+        await update.message.reply_text("❌ Слово не знайдено", reply_markup=get_main_menu())
+
+    leave_state(context, 'dict_delete')
+
+# Скремблер
+async def process_scramble_answer(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    user_id = str(update.effective_user.id)
+    if text.lower() == context.user_data['scramble_word']:
+        unit_of_work(context, user_id).increment({('game_stats', 'total'): 1, ('game_stats', 'correct'): 1})
+        leave_state(context, 'scramble')
+
+        keyboard = [[InlineKeyboardButton("🔄 Грати ще", callback_data="game_scramble")]]
+        await update.message.reply_text("🎉 Правильно!", reply_markup=InlineKeyboardMarkup(keyboard))
+    else:
+        await update.message.reply_text("❌ Спробуйте ще раз")
+
+# Активний діалог з AI
+async def process_dialog_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    dialog_scheduler.submit(str(update.effective_user.id), update, context, text)
+
+# Переклад після кнопки "Перекласти"
+async def process_translation_request(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    leave_state(context, 'translate')
+    await process_translation(update, text, context, message=update.message)
+
+# Кнопки головного меню
+MENU_HANDLERS = {
+    "📖 Текст": text_command,
+    "🔄 Перекласти": translate_command,
+    "➕ Додати слово": add_custom_word_start,
+    "📚 Повторити": review,
+    "📕 Словник": dictionary_command,
+    "🎮 Ігри": games_menu,
+    "💬 Діалог AI": dialog_menu,
+    "🎓 Курси": courses_menu,
+    "📊 Статистика": stats,
+    "⚙️ Налаштування": settings_command,
+    "❓ Допомога": help_command,
+}
+
+# Обробники тексту для станів, що чекають на введення (решта станів - лише кнопки)
+STATE_HANDLERS = {
+    'add_word': process_custom_word,
+    'review_typing': process_typing_answer,
+    'dialog': process_dialog_text,
+    'dict_delete': process_dict_delete,
+    'scramble': process_scramble_answer,
+    'translate': process_translation_request,
+}
+
+# Обробка повідомлень
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text
+    
+    # Меню
+    handler = MENU_HANDLERS.get(text)
+    if handler is not None:
+        await handler(update, context)
         return
-    # Скремблер
-    elif context.user_data.get('scramble_word'):
-        data = init_user(user_id)
-        if text.lower() == context.user_data['scramble_word']:
-            data['game_stats']['total'] += 1
-            data['game_stats']['correct'] += 1
-            save_user_data(user_id, data)
-            context.user_data.clear()
-            
-            keyboard = [[InlineKeyboardButton("🔄 Грати ще", callback_data="game_scramble")]]
-            await update.message.reply_text("🎉 Правильно!", reply_markup=InlineKeyboardMarkup(keyboard))
-        else:
-            await update.message.reply_text("❌ Спробуйте ще раз")
-    # Переклад
-    elif context.user_data.get('waiting_for_translation'):
-        context.user_data['waiting_for_translation'] = False
-        await process_translation(update, text, context, message=update.message)
+    
+    handler = STATE_HANDLERS.get(get_state(context))
+    if handler is not None:
+        await handler(update, context, text)
     else:
         await process_translation(update, text, context, message=update.message)
 
 # Обробка кнопок
+class CallbackRouter:
+    """Маршрутизація callback_data: точні ключі та префікси з розбором payload"""
+
+    def __init__(self):
+        self.exact_routes = {}
+        self.prefix_routes = {}
+        self.prefix_lengths = []
+        self.stats = {}
+        self.dispatched = 0
+
+    def exact(self, key):
+        def register(handler):
+            self.exact_routes[key] = (handler, None)
+            return handler
+        return register
+
+    def prefix(self, prefix, parse=None):
+        def register(handler):
+            self.prefix_routes[prefix] = (handler, parse)
+            # Довші префікси перевіряються першими: vocab_add_ не перекривається vocab_
+            self.prefix_lengths = sorted({len(p) for p in self.prefix_routes}, reverse=True)
+            return handler
+        return register
+
+    def resolve(self, data):
+        route = self.exact_routes.get(data)
+        if route is not None:
+            return data, route, None
+        for length in self.prefix_lengths:
+            prefix = data[:length]
+            route = self.prefix_routes.get(prefix)
+            if route is not None and len(data) >= length:
+                return prefix, route, data[length:]
+        return None, None, None
+
+    async def dispatch(self, update, context):
+        query = update.callback_query
+        data = query.data or ''
+        key, route, payload = self.resolve(data)
+        if route is None:
+            logger.warning(f"Unknown callback data: {data!r}")
+            return
+        handler, parse = route
+        if parse is not None:
+            try:
+                payload = parse(payload)
+            except ValueError:
+                logger.warning(f"Malformed callback data: {data!r}")
+                return
+        started = time.perf_counter()
+        try:
+            await handler(update, context, query, str(update.effective_user.id), payload)
+        finally:
+            self.record(key, time.perf_counter() - started)
+
+    def record(self, key, elapsed):
+        count, total, worst = self.stats.get(key, (0, 0.0, 0.0))
+        self.stats[key] = (count + 1, total + elapsed, max(worst, elapsed))
+        self.dispatched += 1
+        if self.dispatched % 1000 == 0:
+            slowest = sorted(self.stats.items(), key=lambda item: item[1][1] / item[1][0], reverse=True)[:5]
+            summary = ', '.join(f"{key}: {count}x avg {total / count * 1000:.1f}ms max {worst * 1000:.1f}ms"
+                                for key, (count, total, worst) in slowest)
+            logger.info(f"Callback router: {self.dispatched} dispatched, slowest routes: {summary}")
+
+def split_payload(sep, parts):
+    """Розбір payload на фіксовану кількість частин"""
+    def parse(payload):
+        values = payload.split(sep, parts - 1)
+        if len(values) != parts or not all(values):
+            raise ValueError(payload)
+        return values
+    return parse
+
+callback_router = CallbackRouter()
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    
-    user_id = str(update.effective_user.id)
-    data = init_user(user_id)
-    
-    # Додати ще слово
-    if query.data == "add_another_word":
-        context.user_data['adding_custom_word'] = True
-        context.user_data['custom_word_step'] = 'ukrainian'
-        
-        await query.edit_message_text(
-            "➕ **Додати своє слово**\n\n"
-            "Крок 1/2: Напишіть слово українською:\n\n"
-            "💡 Наприклад: собака"
-        )
+    await callback_router.dispatch(update, context)
+
+# Додати ще слово
+@callback_router.exact("add_another_word")
+async def on_add_another_word(update, context, query, user_id, payload):
+    enter_state(context, 'add_word', custom_word_step='ukrainian')
+
+    await query.edit_message_text(
+        "➕ **Додати своє слово**\n\n"
+        "Крок 1/2: Напишіть слово українською:\n\n"
+        "💡 Наприклад: собака"
+    )
+
+# Вибір кількості слів для повторення
+@callback_router.exact("review_scheduled")
+async def on_review_scheduled(update, context, query, user_id, payload):
+    _, due_count = await count_cards_async(user_id)
+
+    if not due_count:
+        await query.edit_message_text("🎉 Слів за розкладом немає!\n\nВиберіть 'Всі слова' для повторення.")
         return
-    
-    # Вибір кількості слів для повторення
-    elif query.data == "review_scheduled":
-        now = datetime.now()
-        due = [i for i, c in enumerate(data['cards']) if datetime.fromisoformat(c['next_review']) <= now]
-        
-        if not due:
-            await query.edit_message_text("🎉 Слів за розкладом немає!\n\nВиберіть 'Всі слова' для повторення.")
-            return
-        
-        context.user_data['review_type'] = 'scheduled'
-        await show_review_mode_selection(query, len(due), 'scheduled', context)
-    
-    elif query.data == "review_all":
-        context.user_data['review_type'] = 'all'
-        await show_review_mode_selection(query, len(data['cards']), 'all', context)
-    
-    elif query.data == "back_to_review_start":
-        # Повертаємось до вибору кількості слів
-        now = datetime.now()
-        due = [i for i, c in enumerate(data['cards']) if datetime.fromisoformat(c['next_review']) <= now]
-        
-        keyboard = [
-            [InlineKeyboardButton(f"📅 По розкладу ({len(due)} слів)", callback_data="review_scheduled")],
-            [InlineKeyboardButton(f"📚 Всі слова ({len(data['cards'])} слів)", callback_data="review_all")]
-        ]
-        
-        if len(due) == 0:
-            message_text = "🎉 **Повторення**\n\nСлів за розкладом: 0\n\nВиберіть режим:"
-        else:
-            message_text = f"📚 **Повторення**\n\nСлів за розкладом: {len(due)}\nВсього слів: {len(data['cards'])}\n\nВиберіть режим:"
-        
-        await query.edit_message_text(message_text, reply_markup=InlineKeyboardMarkup(keyboard))
-    
-    # Вибір режиму повторення
-    elif query.data.startswith("mode_"):
-        parts = query.data.split("_")
-        review_type = parts[1]  # scheduled or all
-        mode = parts[2]  # classic, quiz, fast, typing, reverse
-        
-        if mode == "classic":
-            await start_classic_review(update, context, user_id, review_type)
-        elif mode == "quiz":
-            await start_quiz_review(update, context, user_id, review_type)
-        elif mode == "fast":
-            await start_fast_review(update, context, user_id, review_type)
-        elif mode == "typing":
-            await start_typing_review(update, context, user_id, review_type)
-        elif mode == "reverse":
-            await start_reverse_review(update, context, user_id, review_type)
-    
-    # Швидкий режим - наступна картка
-    elif query.data == "fast_next":
-        due = context.user_data.get('due_cards', [])
-        current_pos = due.index(context.user_data.get('current_card_index'))
-        
-        # Оновлюємо інтервал (2 дні для швидкого режиму)
-        idx = context.user_data.get('current_card_index')
-        data['cards'][idx]['next_review'] = (datetime.now() + timedelta(days=2)).isoformat()
-        data['stats']['total_reviews'] += 1
-        save_user_data(user_id, data)
-        
-        if current_pos + 1 < len(due):
-            next_idx = due[current_pos + 1]
-            context.user_data['current_card_index'] = next_idx
-            card = data['cards'][next_idx]
-            
-            keyboard = [
-                [InlineKeyboardButton("➡️ Далі", callback_data="fast_next")],
-                [InlineKeyboardButton("❌ Завершити", callback_data="fast_end")]
-            ]
-            
-            await query.edit_message_text(
-                f"⚡ **Швидкий режим** - {current_pos + 2}/{len(due)}\n\n"
-                f"🇺🇦 **{card['ukrainian']}**\n"
-                f"🇬🇧 **{card['english']}**",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        else:
-            context.user_data.clear()
-            await query.edit_message_text(
-                "✅ **Швидкий перегляд завершено!**\n\n"
-                f"Переглянуто слів: {len(due)}\n\n"
-                "Всі слова з'являться через 2 дні"
-            )
-    
-    elif query.data == "fast_end":
-        context.user_data.clear()
-        await query.edit_message_text("✅ Швидкий режим завершено!")
-    
-    # Режим написання - пропустити
-    elif query.data == "typing_skip":
-        due = context.user_data.get('due_cards', [])
-        current_pos = due.index(context.user_data.get('current_card_index'))
-        
-        # Пропущене слово - інтервал 1 день
-        idx = context.user_data.get('current_card_index')
-        card = data['cards'][idx]
-        data['cards'][idx]['next_review'] = (datetime.now() + timedelta(days=1)).isoformat()
-        save_user_data(user_id, data)
-        
-        await query.answer(f"Пропущено: {card['english']}", show_alert=False)
-        
-        if current_pos + 1 < len(due):
-            next_idx = due[current_pos + 1]
-            context.user_data['current_card_index'] = next_idx
-            next_card = data['cards'][next_idx]
-            
-            keyboard = [[InlineKeyboardButton("Пропустити", callback_data="typing_skip")]]
-            
-            await query.edit_message_text(
-                f"✍️ **Режим написання** - {current_pos + 2}/{len(due)}\n\n"
-                f"🇺🇦 **{next_card['ukrainian']}**\n\n"
-                f"💡 Напишіть переклад англійською:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        else:
-            # Завершення
-            correct_count = context.user_data.get('typing_correct_count', 0)
-            total = len(due)
-            context.user_data.clear()
-            
-            await query.edit_message_text(
-                f"✅ **Режим написання завершено!**\n\n"
-                f"Правильних: {correct_count}/{total}"
-            )
-    
-    # Реверс режим - відповідь
-    elif query.data.startswith("reverse_answer:"):
-        answer = query.data.split(":", 1)[1]
-        correct = context.user_data.get('reverse_correct_answer')
-        due = context.user_data.get('due_cards', [])
-        current_pos = due.index(context.user_data.get('current_card_index'))
-        
-        is_correct = (answer == correct)
-        
-        if is_correct:
-            context.user_data['reverse_correct_count'] = context.user_data.get('reverse_correct_count', 0) + 1
-            result_emoji = "✅"
-            interval_days = 2
-        else:
-            result_emoji = "❌"
-            interval_days = 1
-        
-        # Оновлюємо картку
-        idx = context.user_data.get('current_card_index')
-        data['cards'][idx]['next_review'] = (datetime.now() + timedelta(days=interval_days)).isoformat()
-        data['stats']['total_reviews'] += 1
-        if is_correct:
-            data['stats']['correct'] += 1
-        save_user_data(user_id, data)
-        
-        # Наступна картка або завершення
-        if current_pos + 1 < len(due):
-            next_idx = due[current_pos + 1]
-            context.user_data['current_card_index'] = next_idx
-            
-            await query.answer(f"{result_emoji}", show_alert=False)
-            await show_reverse_card(query, context, data, due, current_pos + 1)
-        else:
-            # Фінал
-            correct_count = context.user_data.get('reverse_correct_count', 0)
-            total_count = len(due)
-            percentage = int((correct_count / total_count) * 100) if total_count > 0 else 0
-            context.user_data.clear()
-            
-            await query.edit_message_text(
-                f"✅ **Реверс режим завершено!**\n\n"
-                f"📊 Результат: {correct_count}/{total_count} ({percentage}%)\n\n"
-                f"💡 Слова з'являться через 1-2 дні"
-            )
-    
-    elif query.data == "back_to_review":
-        # Повернутися до вибору режиму
-        now = datetime.now()
-        due = [i for i, c in enumerate(data['cards']) if datetime.fromisoformat(c['next_review']) <= now]
-        
+
+    context.user_data['review_type'] = 'scheduled'
+    await show_review_mode_selection(query, due_count, 'scheduled', context)
+
+@callback_router.exact("review_all")
+async def on_review_all(update, context, query, user_id, payload):
+    context.user_data['review_type'] = 'all'
+    total, _ = await count_cards_async(user_id)
+    await show_review_mode_selection(query, total, 'all', context)
+
+@callback_router.exact("back_to_review_start")
+async def on_back_to_review_start(update, context, query, user_id, payload):
+    # Повертаємось до вибору кількості слів
+    total, due_count = await count_cards_async(user_id)
+
+    keyboard = [
+        [InlineKeyboardButton(f"📅 По розкладу ({due_count} слів)", callback_data="review_scheduled")],
+        [InlineKeyboardButton(f"📚 Всі слова ({total} слів)", callback_data="review_all")]
+    ]
+
+    if due_count == 0:
+        message_text = "🎉 **Повторення**\n\nСлів за розкладом: 0\n\nВиберіть режим:"
+    else:
+        message_text = f"📚 **Повторення**\n\nСлів за розкладом: {due_count}\nВсього слів: {total}\n\nВиберіть режим:"
+
+    await query.edit_message_text(message_text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Вибір режиму повторення
+@callback_router.prefix("mode_", split_payload("_", 2))
+async def on_review_mode(update, context, query, user_id, payload):
+    review_type, mode = payload  # scheduled or all; classic, quiz, fast, typing, reverse
+
+    if mode == "classic":
+        await start_classic_review(update, context, user_id, review_type)
+    elif mode == "quiz":
+        await start_quiz_review(update, context, user_id, review_type)
+    elif mode == "fast":
+        await start_fast_review(update, context, user_id, review_type)
+    elif mode == "typing":
+        await start_typing_review(update, context, user_id, review_type)
+    elif mode == "reverse":
+        await start_reverse_review(update, context, user_id, review_type)
+
+# Кнопки "Класичний режим" / "Повторити ще раз" після завершення повторення
+@callback_router.prefix("review_mode_")
+async def on_review_mode_again(update, context, query, user_id, payload):
+    review_type = context.user_data.get('review_type', 'all')
+    await on_review_mode(update, context, query, user_id, (review_type, payload))
+
+# Швидкий режим - наступна картка
+@callback_router.exact("fast_next")
+async def on_fast_next(update, context, query, user_id, payload):
+    if not await review_session_active(query, context, 'fast'):
+        return
+
+    due = context.user_data.get('due_cards', [])
+    current_pos = context.user_data.get('current_card_index')
+
+    # Перегляд без перевірки - не оцінка: картка просто відкладається, стан SM-2/FSRS не змінюється
+    await review_batcher.postpone(user_id, due[current_pos], FAST_REVIEW_POSTPONE_DAYS, {('stats', 'total_reviews'): 1})
+
+    if current_pos + 1 < len(due):
+        context.user_data['current_card_index'] = current_pos + 1
+        card = due[current_pos + 1]
+
         keyboard = [
-            [InlineKeyboardButton("📖 Класичний режим", callback_data="review_mode_classic")],
-            [InlineKeyboardButton("🎯 Вгадай переклад (1 з 4)", callback_data="review_mode_quiz")]
+            [InlineKeyboardButton("➡️ Далі", callback_data="fast_next")],
+            [InlineKeyboardButton("❌ Завершити", callback_data="fast_end")]
         ]
-        
+
         await query.edit_message_text(
-            f"📚 **Режим повторення**\n\n"
-            f"Слів для повторення: {len(due)}\n\n"
-            f"Виберіть режим:",
+            f"⚡ **Швидкий режим** - {current_pos + 2}/{len(due)}\n\n"
+            f"🇺🇦 **{card.ukrainian}**\n"
+            f"🇬🇧 **{card.english}**",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
-    
-    # Відповідь у режимі вікторини
-    elif query.data.startswith("quiz_answer:"):
-        answer = query.data.split(":", 1)[1]
-        correct = context.user_data.get('quiz_correct_answer')
-        due = context.user_data.get('due_cards', [])
-        current_pos = due.index(context.user_data.get('current_card_index'))
-        
-        # Перевіряємо відповідь
-        is_correct = (answer == correct)
-        
-        if is_correct:
-            context.user_data['quiz_correct_count'] = context.user_data.get('quiz_correct_count', 0) + 1
-            result_emoji = "✅"
-            result_text = "Правильно!"
-            # Для правильної відповіді в режимі вікторини - 2 дні
-            interval_days = 2
-        else:
-            result_emoji = "❌"
-            result_text = f"Неправильно! Правильна відповідь: **{correct}**"
-            # Для неправильної відповіді - 1 день
-            interval_days = 1
-        
-        # Оновлюємо картку
-        idx = context.user_data.get('current_card_index')
-        data['cards'][idx]['next_review'] = (datetime.now() + timedelta(days=interval_days)).isoformat()
-        data['stats']['total_reviews'] += 1
-        
-        if is_correct:
-            data['stats']['correct'] += 1
-        
-        save_user_data(user_id, data)
-        
-        # Перевіряємо чи є ще картки
-        if current_pos + 1 < len(due):
-            # Показуємо результат і переходимо до наступної картки
-            next_idx = due[current_pos + 1]
-            context.user_data['current_card_index'] = next_idx
-            
-            # Короткий результат
-            await query.answer(f"{result_emoji} {result_text}", show_alert=False)
-            
-            # Показуємо наступну картку
-            await show_quiz_card(query, context, data, due, current_pos + 1)
-        else:
-            # Фінальний результат
-            correct_count = context.user_data.get('quiz_correct_count', 0)
-            total_count = len(due)
-            percentage = int((correct_count / total_count) * 100) if total_count > 0 else 0
-            
-            # Вибираємо емодзі в залежності від результату
-            if percentage >= 90:
-                result_emoji = "🏆"
-                grade = "Відмінно!"
-            elif percentage >= 70:
-                result_emoji = "🌟"
-                grade = "Добре!"
-            elif percentage >= 50:
-                result_emoji = "👍"
-                grade = "Непогано!"
-            else:
-                result_emoji = "💪"
-                grade = "Продовжуйте практикувати!"
-            
-            context.user_data.clear()
-            
-            keyboard = [
-                [InlineKeyboardButton("🔄 Повторити ще раз", callback_data="review_mode_quiz")],
-                [InlineKeyboardButton("◀️ Головне меню", callback_data="back_to_main")]
-            ]
-            
-            await query.edit_message_text(
-                f"{result_emoji} **Повторення завершено!**\n\n"
-                f"📊 Результат: {correct_count}/{total_count} ({percentage}%)\n"
-                f"🎯 {grade}\n\n"
-                f"✅ Правильних: {correct_count}\n"
-                f"❌ Помилок: {total_count - correct_count}\n\n"
-                f"💡 Правильні слова з'являться через 2 дні\n"
-                f"💡 Помилкові слова з'являться завтра",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-    
-    elif query.data == "back_to_main":
-        await query.edit_message_text("Головне меню 👇")
+    else:
+        leave_state(context, 'review_fast')
+        await review_batcher.flush(user_id)
+        await query.edit_message_text(
+            "✅ **Швидкий перегляд завершено!**\n\n"
+            f"Переглянуто слів: {len(due)}\n\n"
+            f"{next_review_hint(due)}"
+        )
+
+@callback_router.exact("fast_end")
+async def on_fast_end(update, context, query, user_id, payload):
+    leave_state(context, 'review_fast')
+    await review_batcher.flush(user_id)
+    await query.edit_message_text("✅ Швидкий режим завершено!")
+
+# Режим написання - пропустити
+@callback_router.exact("typing_skip")
+async def on_typing_skip(update, context, query, user_id, payload):
+    if not await review_session_active(query, context, 'typing'):
         return
-    
-    # Ігри
-    if query.data == "game_guess":
-        await game_guess_command(update, context, True)
-    elif query.data == "game_scramble":
-        await game_scramble_command(update, context, True)
-    elif query.data.startswith("game_answer:"):
-        answer = query.data.split(":", 1)[1]
-        correct = context.user_data.get('game_correct')
-        
-        data['game_stats']['total'] += 1
-        if answer == correct:
-            data['game_stats']['correct'] += 1
-            await query.edit_message_text("🎉 Правильно!")
-        else:
-            await query.edit_message_text(f"❌ Правильно: {correct}")
-        
-        save_user_data(user_id, data)
-    
-    # Діалоги
-    elif query.data.startswith("dialog_"):
-        if query.data == "dialog_end":
-            context.user_data['dialog_active'] = False
-            context.user_data['dialog_history'] = []
-            await query.edit_message_text("✅ Діалог завершено!\n\nВи чудово попрактикували англійську! 🎉")
-        else:
-            scenario = query.data.replace("dialog_", "")
-            await start_dialog(query, scenario, context)
-    
-    # Курси
-    elif query.data == "course_beginner":
+
+    due = context.user_data.get('due_cards', [])
+    current_pos = context.user_data.get('current_card_index')
+
+    # Пропущене слово - як забуте
+    card = due[current_pos]
+    await review_batcher.record(user_id, card, AGAIN, review_scheduler(context))
+
+    await query.answer(f"Пропущено: {card.english}", show_alert=False)
+
+    if current_pos + 1 < len(due):
+        context.user_data['current_card_index'] = current_pos + 1
+        next_card = due[current_pos + 1]
+
+        keyboard = [[InlineKeyboardButton("Пропустити", callback_data="typing_skip")]]
+
         await query.edit_message_text(
-            "🌱 **Початковий курс**\n\n"
-            "Цей курс допоможе вам вивчити базову англійську.\n\n"
-            "📚 10 уроків\n⏱ 3 місяці\n📝 225 слів\n\n"
-            "Почніть з основ і поступово прогресуйте!"
+            f"✍️ **Режим написання** - {current_pos + 2}/{len(due)}\n\n"
+            f"🇺🇦 **{next_card.ukrainian}**\n\n"
+            f"💡 Напишіть переклад англійською:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
         )
-    elif query.data == "course_info":
+    else:
+        # Завершення
+        correct_count = context.user_data.get('typing_correct_count', 0)
+        total = len(due)
+        leave_state(context, 'review_typing')
+        await review_batcher.flush(user_id)
+
         await query.edit_message_text(
-            "📚 **Інформація про курси**\n\n"
-            "Наші курси структуровані для послідовного навчання.\n\n"
-            "🌱 Початковий (A1→A2)\n"
-            "📘 Середній (B1→B2)\n"
-            "🎓 Просунутий (C1)\n\n"
-            "Кожен курс містить тексти, слова та вправи."
+            f"✅ **Режим написання завершено!**\n\n"
+            f"Правильних: {correct_count}/{total}"
         )
-    
-    # Словник
-    elif query.data == "dict_my":
-        if data['cards']:
-            msg = "📕 **Ваші слова:**\n\n"
-            for c in data['cards'][:10]:
-                msg += f"🇺🇦 {c['ukrainian']} → 🇬🇧 {c['english']}\n"
-            
-            if len(data['cards']) > 10:
-                msg += f"\n...та ще {len(data['cards']) - 10} слів"
-            
-            await query.edit_message_text(msg)
-        else:
-            await query.edit_message_text("Словник порожній")
-    
-    elif query.data == "dict_delete":
-        if data['cards']:
-            msg = "🗑 **Видалити слово**\n\nВаші слова:\n\n"
-            for i, c in enumerate(data['cards'][:15], 1):
-                msg += f"{i}. {c['english']} - {c['ukrainian']}\n"
-            
-            msg += "\n💡 Напишіть номер або назву слова для видалення"
-            context.user_data['dict_delete_mode'] = True
-            await query.edit_message_text(msg)
-        else:
-            await query.edit_message_text("Словник порожній")
-    
-    elif query.data == "dict_thematic":
-        keyboard = [[InlineKeyboardButton(t, callback_data=f"vocab_{t}")] for t in THEMATIC_VOCABULARIES.keys()]
-        await query.edit_message_text("Виберіть тему:", reply_markup=InlineKeyboardMarkup(keyboard))
-    
-    elif query.data.startswith("vocab_"):
-        theme = query.data.replace("vocab_", "")
-        words = THEMATIC_VOCABULARIES.get(theme, {})
-        
-        msg = f"**{theme}**\n\nСлів: {len(words)}\n\n"
-        for i, (en, ua) in enumerate(list(words.items())[:5], 1):
-            msg += f"{i}. {en} - {ua}\n"
-        
-        keyboard = [[InlineKeyboardButton("➕ Додати всі", callback_data=f"vocab_add_{theme}")]]
-        await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard))
-    
-    elif query.data.startswith("vocab_add_"):
-        theme = query.data.replace("vocab_add_", "")
-        words = THEMATIC_VOCABULARIES.get(theme, {})
-        
-        added = 0
-        for en, ua in words.items():
-            if not any(c['english'].lower() == en.lower() for c in data['cards']):
-                data['cards'].append({
-                    'ukrainian': ua,
-                    'english': en,
-                    'added_date': datetime.now().isoformat(),
-                    'next_review': datetime.now().isoformat(),
-                    'interval': 1
-                })
-                added += 1
-        
-        save_user_data(user_id, data)
-        await query.edit_message_text(f"✅ Додано {added} слів!")
-    
-    # Додати слово
-    elif query.data.startswith("add_to_cards:"):
-        parts = query.data.split(":", 2)
-        word1, word2 = parts[1], parts[2]
-        
-        is_cyr = any('\u0400' <= c <= '\u04FF' for c in word1)
-        ua, en = (word1, word2) if is_cyr else (word2, word1)
-        
-        if not any(c['english'].lower() == en.lower() for c in data['cards']):
-            data['cards'].append({
-                'ukrainian': ua,
-                'english': en,
-                'added_date': datetime.now().isoformat(),
-                'next_review': datetime.now().isoformat(),
-                'interval': 1
-            })
-            save_user_data(user_id, data)
-            await query.edit_message_text(f"✅ Додано: {ua} → {en}")
+
+# Реверс режим - відповідь
+@callback_router.prefix("reverse_answer:")
+async def on_reverse_answer(update, context, query, user_id, payload):
+    if not await review_session_active(query, context, 'reverse'):
+        return
+
+    answer = payload
+    correct = context.user_data.get('reverse_correct_answer')
+    due = context.user_data.get('due_cards', [])
+    current_pos = context.user_data.get('current_card_index')
+
+    is_correct = (answer == correct)
+
+    if is_correct:
+        context.user_data['reverse_correct_count'] = context.user_data.get('reverse_correct_count', 0) + 1
+        result_emoji = "✅"
+    else:
+        result_emoji = "❌"
+
+    # Оновлюємо картку
+    increments = {('stats', 'total_reviews'): 1}
+    if is_correct:
+        increments[('stats', 'correct')] = 1
+    await review_batcher.record(user_id, due[current_pos], GOOD if is_correct else AGAIN, review_scheduler(context), increments)
+
+    # Наступна картка або завершення
+    if current_pos + 1 < len(due):
+        context.user_data['current_card_index'] = current_pos + 1
+
+        await query.answer(f"{result_emoji}", show_alert=False)
+        await show_reverse_card(query, context, user_id, due, current_pos + 1)
+    else:
+        # Фінал
+        correct_count = context.user_data.get('reverse_correct_count', 0)
+        total_count = len(due)
+        percentage = int((correct_count / total_count) * 100) if total_count > 0 else 0
+        leave_state(context, 'review_reverse')
+        await review_batcher.flush(user_id)
+
+        await query.edit_message_text(
+            f"✅ **Реверс режим завершено!**\n\n"
+            f"📊 Результат: {correct_count}/{total_count} ({percentage}%)\n\n"
+            f"{next_review_hint(due)}"
+        )
+
+@callback_router.exact("back_to_review")
+async def on_back_to_review(update, context, query, user_id, payload):
+    # Повернутися до вибору режиму
+    _, due_count = await count_cards_async(user_id)
+
+    keyboard = [
+        [InlineKeyboardButton("📖 Класичний режим", callback_data="review_mode_classic")],
+        [InlineKeyboardButton("🎯 Вгадай переклад (1 з 4)", callback_data="review_mode_quiz")]
+    ]
+
+    await query.edit_message_text(
+        f"📚 **Режим повторення**\n\n"
+        f"Слів для повторення: {due_count}\n\n"
+        f"Виберіть режим:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+# Відповідь у режимі вікторини
+@callback_router.prefix("quiz_answer:")
+async def on_quiz_answer(update, context, query, user_id, payload):
+    if not await review_session_active(query, context, 'quiz'):
+        return
+
+    answer = payload
+    correct = context.user_data.get('quiz_correct_answer')
+    due = context.user_data.get('due_cards', [])
+    current_pos = context.user_data.get('current_card_index')
+
+    # Перевіряємо відповідь
+    is_correct = (answer == correct)
+
+    if is_correct:
+        context.user_data['quiz_correct_count'] = context.user_data.get('quiz_correct_count', 0) + 1
+        result_emoji = "✅"
+        result_text = "Правильно!"
+    else:
+        result_emoji = "❌"
+        result_text = f"Неправильно! Правильна відповідь: **{correct}**"
+
+    # Оновлюємо картку
+    increments = {('stats', 'total_reviews'): 1}
+
+    if is_correct:
+        increments[('stats', 'correct')] = 1
+
+    await review_batcher.record(user_id, due[current_pos], GOOD if is_correct else AGAIN, review_scheduler(context), increments)
+
+    # Перевіряємо чи є ще картки
+    if current_pos + 1 < len(due):
+        # Показуємо результат і переходимо до наступної картки
+        context.user_data['current_card_index'] = current_pos + 1
+
+        # Короткий результат
+        await query.answer(f"{result_emoji} {result_text}", show_alert=False)
+
+        # Показуємо наступну картку
+        await show_quiz_card(query, context, user_id, due, current_pos + 1)
+    else:
+        # Фінальний результат
+        correct_count = context.user_data.get('quiz_correct_count', 0)
+        total_count = len(due)
+        percentage = int((correct_count / total_count) * 100) if total_count > 0 else 0
+
+        # Вибираємо емодзі в залежності від результату
+        if percentage >= 90:
+            result_emoji = "🏆"
+            grade = "Відмінно!"
+        elif percentage >= 70:
+            result_emoji = "🌟"
+            grade = "Добре!"
+        elif percentage >= 50:
+            result_emoji = "👍"
+            grade = "Непогано!"
         else:
-            await query.edit_message_text("Вже є в словнику!")
-    
-    # Повторення
-    elif query.data == "show_answer":
-        idx = context.user_data.get('current_card_index')
-        card = data['cards'][idx]
-        
+            result_emoji = "💪"
+            grade = "Продовжуйте практикувати!"
+
+        leave_state(context, 'review_quiz')
+        await review_batcher.flush(user_id)
+
         keyboard = [
-            [InlineKeyboardButton("😊 Легко (7д)", callback_data="diff_easy")],
-            [InlineKeyboardButton("🤔 Середньо (3д)", callback_data="diff_medium")],
-            [InlineKeyboardButton("😓 Важко (1д)", callback_data="diff_hard")]
+            [InlineKeyboardButton("🔄 Повторити ще раз", callback_data="review_mode_quiz")],
+            [InlineKeyboardButton("◀️ Головне меню", callback_data="back_to_main")]
         ]
-        
+
         await query.edit_message_text(
-            f"🇺🇦 {card['ukrainian']}\n\n🇬🇧 {card['english']}\n\nНаскільки добре?",
+            f"{result_emoji} **Повторення завершено!**\n\n"
+            f"📊 Результат: {correct_count}/{total_count} ({percentage}%)\n"
+            f"🎯 {grade}\n\n"
+            f"✅ Правильних: {correct_count}\n"
+            f"❌ Помилок: {total_count - correct_count}\n\n"
+            f"{next_review_hint(due)}",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
+
+@callback_router.exact("back_to_main")
+async def on_back_to_main(update, context, query, user_id, payload):
+    await query.edit_message_text("Головне меню 👇")
+
+# Ігри
+@callback_router.exact("game_guess")
+async def on_game_guess(update, context, query, user_id, payload):
+    await game_guess_command(update, context, True)
+
+@callback_router.exact("game_scramble")
+async def on_game_scramble(update, context, query, user_id, payload):
+    await game_scramble_command(update, context, True)
+
+@callback_router.prefix("game_answer:")
+async def on_game_answer(update, context, query, user_id, payload):
+    uow = unit_of_work(context, user_id)
     
-    elif query.data.startswith("diff_"):
-        diff = query.data.split("_")[1]
-        intervals = {'easy': 7, 'medium': 3, 'hard': 1}
-        
-        idx = context.user_data.get('current_card_index')
-        data['cards'][idx]['next_review'] = (datetime.now() + timedelta(days=intervals[diff])).isoformat()
-        data['stats']['total_reviews'] += 1
-        
-        if diff in ['easy', 'medium']:
-            data['stats']['correct'] += 1
-        
-        save_user_data(user_id, data)
-        
-        due = context.user_data['due_cards']
-        pos = due.index(idx)
-        
-        if pos + 1 < len(due):
-            next_idx = due[pos + 1]
-            context.user_data['current_card_index'] = next_idx
-            card = data['cards'][next_idx]
-            
-            await query.edit_message_text(
-                f"📚 Картка {pos + 2}/{len(due)}\n\n🇺🇦 **{card['ukrainian']}**",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Показати", callback_data="show_answer")]])
-            )
-        else:
-            context.user_data.clear()
-            
-            keyboard = [
-                [InlineKeyboardButton("🔄 Повторити ще раз", callback_data="review_mode_classic")],
-                [InlineKeyboardButton("◀️ Головне меню", callback_data="back_to_main")]
-            ]
-            
-            await query.edit_message_text(
-                "🎉 **Все повторено!**\n\nВи чудово попрацювали!",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-    
-    # Налаштування
-    elif query.data == "settings_level":
-        keyboard = [
-            [InlineKeyboardButton("A1", callback_data="level_A1")],
-            [InlineKeyboardButton("A2", callback_data="level_A2")],
-            [InlineKeyboardButton("B1", callback_data="level_B1")],
-            [InlineKeyboardButton("B2", callback_data="level_B2")],
-            [InlineKeyboardButton("C1", callback_data="level_C1")]
-        ]
-        await query.edit_message_text("Виберіть рівень:", reply_markup=InlineKeyboardMarkup(keyboard))
-    
-    elif query.data.startswith("level_"):
-        level = query.data.split("_")[1]
-        data['level'] = level
-        data['read_texts'] = []
-        save_user_data(user_id, data)
-        await query.edit_message_text(f"✅ Рівень: {level}")
-    
-    elif query.data == "settings_language":
-        keyboard = [
-            [InlineKeyboardButton("🇬🇧 English", callback_data="lang_en")],
-            [InlineKeyboardButton("🇩🇪 Deutsch", callback_data="lang_de")],
-            [InlineKeyboardButton("🇫🇷 Français", callback_data="lang_fr")]
-        ]
-        await query.edit_message_text("Мова:", reply_markup=InlineKeyboardMarkup(keyboard))
-    
-    elif query.data.startswith("lang_"):
-        lang = query.data.split("_")[1]
-        data['target_language'] = lang
-        save_user_data(user_id, data)
-        await query.edit_message_text(f"✅ Мова встановлено")
-    
-    elif query.data == "settings_reminders":
+    answer = payload
+    correct = context.user_data.get('game_correct')
+
+    increments = {('game_stats', 'total'): 1}
+    if answer == correct:
+        increments[('game_stats', 'correct')] = 1
+        await query.edit_message_text("🎉 Правильно!")
+    else:
+        await query.edit_message_text(f"❌ Правильно: {correct}")
+
+    uow.increment(increments)
+
+# Діалоги
+@callback_router.exact("dialog_end")
+async def on_dialog_end(update, context, query, user_id, payload):
+    leave_state(context, 'dialog')
+    await query.edit_message_text("✅ Діалог завершено!\n\nВи чудово попрактикували англійську! 🎉")
+
+@callback_router.prefix("dialog_")
+async def on_dialog_scenario(update, context, query, user_id, payload):
+    await start_dialog(query, payload, context)
+
+# Курси
+@callback_router.exact("course_beginner")
+async def on_course_beginner(update, context, query, user_id, payload):
+    await query.edit_message_text(
+        "🌱 **Початковий курс**\n\n"
+        "Цей курс допоможе вам вивчити базову англійську.\n\n"
+        "📚 10 уроків\n⏱ 3 місяці\n📝 225 слів\n\n"
+        "Почніть з основ і поступово прогресуйте!"
+    )
+
+@callback_router.exact("course_info")
+async def on_course_info(update, context, query, user_id, payload):
+    await query.edit_message_text(
+        "📚 **Інформація про курси**\n\n"
+        "Наші курси структуровані для послідовного навчання.\n\n"
+        "🌱 Початковий (A1→A2)\n"
+        "📘 Середній (B1→B2)\n"
+        "🎓 Просунутий (C1)\n\n"
+        "Кожен курс містить тексти, слова та вправи."
+    )
+
+# Словник
+@callback_router.exact("dict_my")
+async def on_dict_my(update, context, query, user_id, payload):
+    total, _ = await count_cards_async(user_id)
+    if total:
+        msg = "📕 **Ваші слова:**\n\n"
+        for c in await load_cards_async(user_id, 10):
+            msg += f"🇺🇦 {c.ukrainian} → 🇬🇧 {c.english}\n"
+
+        if total > 10:
+            msg += f"\n...та ще {total - 10} слів"
+
+        await query.edit_message_text(msg)
+    else:
+        await query.edit_message_text("Словник порожній")
+
+@callback_router.exact("dict_delete")
+async def on_dict_delete(update, context, query, user_id, payload):
+    cards = await load_cards_async(user_id, 15)
+    if cards:
+        msg = "🗑 **Видалити слово**\n\nВаші слова:\n\n"
+        for i, c in enumerate(cards, 1):
+            msg += f"{i}. {c.english} - {c.ukrainian}\n"
+
+        msg += "\n💡 Напишіть номер або назву слова для видалення"
+        enter_state(context, 'dict_delete')
+        await query.edit_message_text(msg)
+    else:
+        await query.edit_message_text("Словник порожній")
+
+@callback_router.exact("dict_thematic")
+async def on_dict_thematic(update, context, query, user_id, payload):
+    keyboard = [[InlineKeyboardButton(t, callback_data=f"vocab_{t}")] for t in THEMATIC_VOCABULARIES.keys()]
+    await query.edit_message_text("Виберіть тему:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+@callback_router.prefix("vocab_")
+async def on_vocab(update, context, query, user_id, payload):
+    theme = payload
+    words = THEMATIC_VOCABULARIES.get(theme, {})
+
+    msg = f"**{theme}**\n\nСлів: {len(words)}\n\n"
+    for i, (en, ua) in enumerate(list(words.items())[:5], 1):
+        msg += f"{i}. {en} - {ua}\n"
+
+    keyboard = [[InlineKeyboardButton("➕ Додати всі", callback_data=f"vocab_add_{theme}")]]
+    await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard))
+
+@callback_router.prefix("vocab_add_")
+async def on_vocab_add(update, context, query, user_id, payload):
+    theme = payload
+    words = THEMATIC_VOCABULARIES.get(theme, {})
+
+    added = await add_cards_async(user_id, [Card(ua, en) for en, ua in words.items()])
+    await query.edit_message_text(f"✅ Додано {added} слів!")
+
+# Додати слово
+@callback_router.prefix("add_to_cards:", split_payload(":", 2))
+async def on_add_to_cards(update, context, query, user_id, payload):
+    word1, word2 = payload
+
+    is_cyr = any('\u0400' <= c <= '\u04FF' for c in word1)
+    ua, en = (word1, word2) if is_cyr else (word2, word1)
+
+    if await add_cards_async(user_id, [Card(ua, en)]):
+        await query.edit_message_text(f"✅ Додано: {ua} → {en}")
+    else:
+        await query.edit_message_text("Вже є в словнику!")
+
+# Повторення
+@callback_router.exact("show_answer")
+async def on_show_answer(update, context, query, user_id, payload):
+    if not await review_session_active(query, context, 'classic'):
+        return
+
+    idx = context.user_data.get('current_card_index')
+    card = context.user_data['due_cards'][idx]
+
+    keyboard = [
+        [InlineKeyboardButton("😊 Легко", callback_data="diff_easy")],
+        [InlineKeyboardButton("🤔 Середньо", callback_data="diff_medium")],
+        [InlineKeyboardButton("😓 Важко", callback_data="diff_hard")]
+    ]
+
+    await query.edit_message_text(
+        f"🇺🇦 {card.ukrainian}\n\n🇬🇧 {card.english}\n\nНаскільки добре?",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+@callback_router.prefix("diff_")
+async def on_difficulty(update, context, query, user_id, payload):
+    if not await review_session_active(query, context, 'classic'):
+        return
+
+    diff = payload
+    grades = {'easy': EASY, 'medium': GOOD, 'hard': HARD}
+
+    due = context.user_data['due_cards']
+    pos = context.user_data.get('current_card_index')
+    increments = {('stats', 'total_reviews'): 1}
+
+    if diff in ['easy', 'medium']:
+        increments[('stats', 'correct')] = 1
+
+    await review_batcher.record(user_id, due[pos], grades[diff], review_scheduler(context), increments)
+
+    if pos + 1 < len(due):
+        context.user_data['current_card_index'] = pos + 1
+        card = due[pos + 1]
+
+        await query.edit_message_text(
+            f"📚 Картка {pos + 2}/{len(due)}\n\n🇺🇦 **{card.ukrainian}**",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Показати", callback_data="show_answer")]])
+        )
+    else:
+        leave_state(context, 'review_classic')
+        await review_batcher.flush(user_id)
+
         keyboard = [
-            [InlineKeyboardButton("09:00", callback_data="rem_09:00"), InlineKeyboardButton("12:00", callback_data="rem_12:00")],
-            [InlineKeyboardButton("18:00", callback_data="rem_18:00"), InlineKeyboardButton("20:00", callback_data="rem_20:00")],
-            [InlineKeyboardButton("❌ Вимкнути", callback_data="rem_off")]
+            [InlineKeyboardButton("🔄 Повторити ще раз", callback_data="review_mode_classic")],
+            [InlineKeyboardButton("◀️ Головне меню", callback_data="back_to_main")]
         ]
-        
-        status = "✅ увімкнені" if data['reminders']['enabled'] else "❌ вимкнені"
+
         await query.edit_message_text(
-            f"⏰ Нагадування {status}\n\nЧас: {data['reminders']['time']}\n\nВиберіть час:",
+            "🎉 **Все повторено!**\n\nВи чудово попрацювали!",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
+
+# Налаштування
+@callback_router.exact("settings_level")
+async def on_settings_level(update, context, query, user_id, payload):
+    keyboard = [
+        [InlineKeyboardButton("A1", callback_data="level_A1")],
+        [InlineKeyboardButton("A2", callback_data="level_A2")],
+        [InlineKeyboardButton("B1", callback_data="level_B1")],
+        [InlineKeyboardButton("B2", callback_data="level_B2")],
+        [InlineKeyboardButton("C1", callback_data="level_C1")]
+    ]
+    await query.edit_message_text("Виберіть рівень:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+@callback_router.prefix("level_")
+async def on_level(update, context, query, user_id, payload):
+    uow = unit_of_work(context, user_id)
     
-    elif query.data.startswith("rem_"):
-        if query.data == "rem_off":
-            data['reminders']['enabled'] = False
-            save_user_data(user_id, data)
-            await query.edit_message_text("❌ Нагадування вимкнено")
-        else:
-            time = query.data.replace("rem_", "")
-            data['reminders']['time'] = time
-            data['reminders']['enabled'] = True
-            save_user_data(user_id, data)
-            await query.edit_message_text(f"✅ Нагадування о {time}")
+    level = payload
+    uow.set({('level',): level, ('read_texts',): []})
+    await query.edit_message_text(f"✅ Рівень: {level}")
+
+@callback_router.exact("settings_language")
+async def on_settings_language(update, context, query, user_id, payload):
+    keyboard = [
+        [InlineKeyboardButton("🇬🇧 English", callback_data="lang_en")],
+        [InlineKeyboardButton("🇩🇪 Deutsch", callback_data="lang_de")],
+        [InlineKeyboardButton("🇫🇷 Français", callback_data="lang_fr")]
+    ]
+    await query.edit_message_text("Мова:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+@callback_router.prefix("lang_")
+async def on_language(update, context, query, user_id, payload):
+    uow = unit_of_work(context, user_id)
+    
+    lang = payload
+    uow.set({('target_language',): lang})
+    await query.edit_message_text(f"✅ Мова встановлено")
+
+@callback_router.exact("settings_scheduler")
+async def on_settings_scheduler(update, context, query, user_id, payload):
+    data = await unit_of_work(context, user_id).load()
+    
+    keyboard = [
+        [InlineKeyboardButton(scheduler.title, callback_data=f"srs_{name}")]
+        for name, scheduler in SCHEDULERS.items()
+    ]
+
+    await query.edit_message_text(
+        f"🧠 Алгоритм повторення: {get_scheduler(data).title}\n\n"
+        f"SM-2 - класичні зростаючі інтервали\n"
+        f"FSRS - модель пам'яті, менше повторень при тій самій якості",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+@callback_router.prefix("srs_")
+async def on_scheduler(update, context, query, user_id, payload):
+    uow = unit_of_work(context, user_id)
+    
+    scheduler = SCHEDULERS.get(payload)
+    if scheduler is not None:
+        uow.set({('scheduler',): scheduler.name})
+        await review_batcher.flush(user_id)
+        count = await recompute_schedules_async(user_id, scheduler)
+        await query.edit_message_text(f"✅ Алгоритм: {scheduler.title}\n\n🔄 Перераховано розклад {count} слів")
+
+@callback_router.exact("settings_reminders")
+async def on_settings_reminders(update, context, query, user_id, payload):
+    data = await unit_of_work(context, user_id).load()
+    
+    keyboard = [
+        [InlineKeyboardButton("09:00", callback_data="rem_09:00"), InlineKeyboardButton("12:00", callback_data="rem_12:00")],
+        [InlineKeyboardButton("18:00", callback_data="rem_18:00"), InlineKeyboardButton("20:00", callback_data="rem_20:00")],
+        [InlineKeyboardButton("❌ Вимкнути", callback_data="rem_off")]
+    ]
+
+    status = "✅ увімкнені" if data['reminders']['enabled'] else "❌ вимкнені"
+    await query.edit_message_text(
+        f"⏰ Нагадування {status}\n\nЧас: {data['reminders']['time']}\n\nВиберіть час:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+@callback_router.exact("rem_off")
+async def on_reminder_off(update, context, query, user_id, payload):
+    unit_of_work(context, user_id).set({('reminders', 'enabled'): False})
+    await clear_reminder_async(user_id)
+    await query.edit_message_text("❌ Нагадування вимкнено")
+
+@callback_router.prefix("rem_")
+async def on_reminder_time(update, context, query, user_id, payload):
+    remind_time = payload
+    unit_of_work(context, user_id).set({('reminders', 'time'): remind_time, ('reminders', 'enabled'): True})
+    await set_reminder_async(user_id, remind_time)
+    await query.edit_message_text(f"✅ Нагадування о {remind_time}")
 
 # Нагадування
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", "500"))
+# Пропущені (наприклад, під час перезапуску) нагадування старші за це вікно не надсилаються
+REMINDER_CATCHUP_WINDOW = float(os.getenv("REMINDER_CATCHUP_WINDOW", str(3 * 3600)))
+
+# Ліміти Telegram: ~30 повідомлень на секунду загалом і 1 на секунду в один чат
+REMINDER_CONCURRENCY = int(os.getenv("REMINDER_CONCURRENCY", "20"))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_CHAT_INTERVAL = float(os.getenv("TELEGRAM_CHAT_INTERVAL", "1.0"))
+REMINDER_MAX_RETRIES = int(os.getenv("REMINDER_MAX_RETRIES", "3"))
+
+class TokenBucket:
+    """Token bucket для asyncio; pause() зупиняє видачу токенів (flood control)"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def reminder_text(due_count):
+    messages = [
+        f"⏰ Не забудьте попрактикувати!\n\n📚 Повторіть кілька слів сьогодні.",
+        f"⏰ Час вивчати!\n\n🎮 Може зіграємо в Скремблер?",
+        f"⏰ Вітаю!\n\n📖 Може прочитаєте новий текст сьогодні?",
+    ]
+    if due_count:
+        messages.append(f"⏰ Час практикувати!\n\nУ вас {due_count} слів для повторення.")
+    return random.choice(messages)
+
+def request_not_sent(error):
+    """Помилка виникла ще до відправки запиту (немає з'єднання чи вільного місця в пулі)"""
+    return isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+class ReminderDelivery:
+    """Паралельна відправка нагадувань в межах лімітів Telegram"""
+
+    def __init__(self, concurrency, global_rate, chat_interval, max_retries):
+        self.slots = asyncio.Semaphore(concurrency)
+        # Без запасу токенів: рівномірний темп безпечніший для flood control
+        self.bucket = TokenBucket(global_rate, 1)
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self.chat_next_send = {}
+
+    async def deliver(self, application, user_ids):
+        """Надсилає нагадування всім user_ids і повертає метрики відправки"""
+        stats = {'sent': 0, 'failed': 0, 'blocked': 0, 'retries': 0, 'uncertain': 0}
+        started = time.monotonic()
+        
+        # Кількість слів до повторення для всієї пачки - одним запитом
+        counts = await count_cards_batch_async(user_ids) if user_ids else {}
+        
+        await asyncio.gather(*(
+            self._deliver_one(application, user_id, counts.get(user_id, (0, 0))[1], stats)
+            for user_id in user_ids
+        ))
+        
+        elapsed = time.monotonic() - started
+        if user_ids:
+            logger.info(
+                f"Reminders delivered: {stats} in {elapsed:.1f}s "
+                f"({stats['sent'] / max(elapsed, 0.001):.1f} msg/s)"
+            )
+        
+        # Прибираємо записи чатів, для яких інтервал уже минув
+        now = time.monotonic()
+        self.chat_next_send = {chat: at for chat, at in self.chat_next_send.items() if at > now}
+        return stats
+
+    async def _wait_for_chat(self, chat_id):
+        now = time.monotonic()
+        send_at = max(now, self.chat_next_send.get(chat_id, 0))
+        self.chat_next_send[chat_id] = send_at + self.chat_interval
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+
+    async def _deliver_one(self, application, user_id, due_count, stats):
+        async with self.slots:
+            text = reminder_text(due_count)
+            
+            for attempt in range(self.max_retries + 1):
+                await self._wait_for_chat(user_id)
+                await self.bucket.acquire()
+                try:
+                    await application.bot.send_message(chat_id=user_id, text=text, reply_markup=get_main_menu())
+                    stats['sent'] += 1
+                    return
+                except RetryAfter as e:
+                    # Flood control стосується всього бота, тому пауза глобальна
+                    retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                    self.bucket.pause(retry_after)
+                    logger.warning(f"Flood control while sending reminders, pausing for {retry_after}s")
+                except Forbidden:
+                    # Користувач заблокував бота - нагадування більше не надсилаємо
+                    stats['blocked'] += 1
+                    await clear_reminder_async(user_id)
+                    # Налаштування мають показувати нагадування вимкненими
+                    await update_user_fields_async(user_id, {('reminders', 'enabled'): False})
+                    return
+                except BadRequest as e:
+                    logger.error(f"Error sending reminder to {user_id}: {e}")
+                    stats['failed'] += 1
+                    return
+                except (TimedOut, NetworkError) as e:
+                    if not request_not_sent(e):
+                        # Запит міг дійти до Telegram (наприклад, таймаут читання відповіді) -
+                        # повтор може надіслати нагадування вдруге, тому не повторюємо
+                        logger.warning(f"Reminder to {user_id} may or may not have been delivered: {e!r}")
+                        stats['uncertain'] += 1
+                        return
+                    logger.warning(f"Network error sending reminder to {user_id}: {e!r}")
+                    await asyncio.sleep(2 ** attempt)
+                except Exception as e:
+                    logger.error(f"Error sending reminder to {user_id}: {e}")
+                    stats['failed'] += 1
+                    return
+                stats['retries'] += 1
+            
+            stats['failed'] += 1
+
+reminder_delivery = ReminderDelivery(REMINDER_CONCURRENCY, TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_INTERVAL, REMINDER_MAX_RETRIES)
+
 async def send_reminders(application: Application):
-    """Відправляє нагадування користувачам"""
+    """Відправляє нагадування, час яких настав, включно з пропущеними хвилинами"""
     while True:
         try:
             now = datetime.now()
-            current_time = now.strftime("%H:%M")
-            
-            all_users = get_all_users()
             
-            for user_id, data in all_users.items():
-                reminders = data.get('reminders', {})
+            # Забираємо лише ті нагадування, що настали, пачками за індексом next_fire_at
+            while True:
+                due = await claim_due_reminders_async(now, REMINDER_BATCH_SIZE)
                 
-                if reminders.get('enabled') and reminders.get('time') == current_time:
-                    try:
-                        cards_count = len(data.get('cards', []))
-                        
-                        messages = [
-                            f"⏰ Час практикувати!\n\nУ вас {cards_count} слів для повторення.",
-                            f"⏰ Не забудьте попрактикувати!\n\n📚 Повторіть кілька слів сьогодні.",
-                            f"⏰ Час вивчати!\n\n🎮 Може зіграємо в Скремблер?",
-                            f"⏰ Вітаю!\n\n📖 Може прочитаєте новий текст сьогодні?",
-                        ]
-                        
-                        message = random.choice(messages)
-                        
-                        await application.bot.send_message(
-                            chat_id=user_id,
-                            text=message,
-                            reply_markup=get_main_menu()
-                        )
-                        
-                        logger.info(f"Reminder sent to user {user_id}")
-                    
-                    except Exception as e:
-                        logger.error(f"Error sending reminder to {user_id}: {e}")
-            
-            await asyncio.sleep(60)
+                user_ids = []
+                for user_id, scheduled_at in due:
+                    if (now - scheduled_at).total_seconds() > REMINDER_CATCHUP_WINDOW:
+                        logger.info(f"Skipping stale reminder for user {user_id} scheduled at {scheduled_at}")
+                        continue
+                    user_ids.append(user_id)
+                
+                await reminder_delivery.deliver(application, user_ids)
+                
+                if len(due) < REMINDER_BATCH_SIZE:
+                    break
         
         except Exception as e:
             logger.error(f"Error in send_reminders: {e}")
-            await asyncio.sleep(60)
+        
+        # Прокидаємось на початку наступної хвилини, щоб затримки не накопичувались
+        now = datetime.now()
+        await asyncio.sleep(60 - now.second - now.microsecond / 1_000_000)
+
+# Паралельна обробка апдейтів: різні користувачі - паралельно, апдейти одного користувача - по черзі
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "1024"))
+
+# Режим отримання апдейтів: long polling або webhook (вбудований HTTP-сервер PTB)
+BOT_MODE = os.getenv("BOT_MODE", "webhook" if os.getenv("WEBHOOK_URL") else "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+# Telegram передає його в заголовку X-Telegram-Bot-Api-Secret-Token, запити без нього відхиляються
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Лише ті типи апдейтів, які бот обробляє
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обробляє апдейти конкурентно, зберігаючи порядок у межах одного користувача
+
+    Семафор PTB обмежує кількість апдейтів у роботі (включно з тими, що чекають
+    на свого користувача), а власний семафор - кількість обробників, що виконуються
+    одночасно. Слот береться лише після блокування користувача, тож черга одного
+    активного користувача не займає слоти інших.
+    """
+
+    def __init__(self, concurrency, max_pending):
+        super().__init__(max(concurrency, max_pending))
+        self.concurrency = concurrency
+        self.slots = None
+        self.locks = {}
+        self.stats = {'processed': 0, 'waited': 0}
+
+    @staticmethod
+    def key(update):
+        if isinstance(update, Update):
+            if update.effective_user is not None:
+                return update.effective_user.id
+            if update.effective_chat is not None:
+                return ('chat', update.effective_chat.id)
+        return None
+
+    async def initialize(self):
+        self.slots = asyncio.Semaphore(self.concurrency)
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        key = self.key(update)
+        if key is None:
+            async with self.slots:
+                await coroutine
+            return
+        # [lock, кількість апдейтів користувача в роботі] - запис видаляється разом з останнім
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        if entry[0].locked():
+            self.stats['waited'] += 1
+        try:
+            async with entry[0], self.slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+            self.count()
+
+    def count(self):
+        self.stats['processed'] += 1
+        if self.stats['processed'] % 1000 == 0:
+            logger.info(f"Update processor: {self.stats}, {len(self.locks)} users in flight")
 
 def main():
     # Ініціалізація БД
     init_database()
     
     TOKEN = os.getenv("TOKEN")
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING))
+        .build()
+    )
     
     # Команди
     application.add_handler(CommandHandler("start", start))
@@ -1880,15 +3863,44 @@ def main():
     application.add_handler(CommandHandler("dictionary", dictionary_command))
     application.add_handler(CallbackQueryHandler(button_callback))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(TypeHandler(Update, flush_unit_of_work), group=1)
     
     # Запуск нагадувань після старту бота
     async def post_init(app: Application) -> None:
         app.create_task(send_reminders(app))
+        if user_cache is not None:
+            app.create_task(user_cache.run_flusher(USER_CACHE_FLUSH_INTERVAL))
+        app.create_task(review_batcher.run_flusher(REVIEW_FLUSH_INTERVAL))
+    
+    async def post_shutdown(app: Application) -> None:
+        await review_batcher.flush_all()
+        if user_cache is not None:
+            await user_cache.flush(force=True)
+        await http_client.close()
+        network_executor.shutdown(wait=False, cancel_futures=True)
+        db_executor.shutdown(wait=True)
+        db_pool.close()
     
     application.post_init = post_init
-    
-    print("🤖 Бот з PostgreSQL запущено!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    application.post_shutdown = post_shutdown
+    
+    if BOT_MODE == 'webhook':
+        if not WEBHOOK_URL or not WEBHOOK_SECRET:
+            raise RuntimeError("Webhook mode requires WEBHOOK_URL and WEBHOOK_SECRET")
+        
+        print(f"🤖 Бот з PostgreSQL запущено (webhook на порту {WEBHOOK_PORT})!")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        print("🤖 Бот з PostgreSQL запущено!")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()